@@ -0,0 +1,96 @@
+""" simulated device fleets for the benchmarks
+
+FleetScanner reports a configurable fleet of bulbs and sensors, with churn
+(devices replaced and state changes between scans) and hosts shared by
+several devices, RecordingBulb keeps the timestamp of every command it gets
+"""
+import random
+import time
+
+from ovos_utils.messagebus import FakeBus
+
+from ovos_PHAL_plugin_commonIOT.opm.base import IOTScannerPlugin, Sensor
+from ovos_PHAL_plugin_commonIOT.opm.lights import RGBBulb
+
+
+class FleetBulb(RGBBulb):
+    __slots__ = ()
+
+
+class FleetSensor(Sensor):
+    __slots__ = ()
+
+
+AREAS = ("kitchen", "living room", "bedroom", "office", "garage", "garden")
+
+
+class FleetScanner(IOTScannerPlugin):
+    """ poll mode scanner reporting n_devices synthetic devices
+
+    churn: fraction of the fleet replaced by new devices, and fraction
+    changing state, every time churn_fleet() is called
+    duplicate_hosts: fraction of the fleet sharing its host with another
+    device, they end up in the same alias group"""
+
+    def __init__(self, n_devices, churn=0.0, duplicate_hosts=0.0, seed=0,
+                 bus=None, name="fleet", **kwargs):
+        super().__init__(bus=bus or FakeBus(), name=name, **kwargs)
+        self.n_devices = n_devices
+        self.churn = churn
+        self.n_duplicates = int(n_devices * duplicate_hosts)
+        self.random = random.Random(seed)
+        self.generation = [0] * n_devices  # bumped when a device is replaced
+        self.states = [False] * n_devices
+
+    def churn_fleet(self):
+        k = int(self.n_devices * self.churn)
+        for i in self.random.sample(range(self.n_devices), k):
+            self.generation[i] += 1
+        for i in self.random.sample(range(self.n_devices), k):
+            self.states[i] = not self.states[i]
+
+    def device_id(self, i):
+        return f"{self.name}-{i}-{self.generation[i]}"
+
+    def host(self, i):
+        # the first 2 * n_duplicates devices are paired on a shared host
+        if i < 2 * self.n_duplicates:
+            i -= i % 2
+        return f"10.{i // 65536}.{i // 256 % 256}.{i % 256}"
+
+    def scan(self):
+        for i in range(self.n_devices):
+            device_cls = FleetBulb if i % 2 else FleetSensor
+            area = AREAS[i // 2 % len(AREAS)]
+            name = f"{area} {'lamp' if i % 2 else 'sensor'} {i}"
+            yield self.intern_device(device_cls, self.device_id(i), host=self.host(i),
+                                     name=name, area=area,
+                                     raw_data={"power": self.states[i]})
+
+
+class RecordingBulb(RGBBulb):
+    """ fake bulb keeping (monotonic time, command, value) for every command"""
+    __slots__ = ("commands", "_on")
+
+    def __init__(self, device_id, host=None, **kwargs):
+        super().__init__(device_id, host, **kwargs)
+        self.commands = []
+        self._on = False
+
+    @property
+    def is_on(self):
+        return self._on
+
+    def turn_on(self):
+        self._on = True
+        self.commands.append((time.monotonic(), "on", None))
+
+    def turn_off(self):
+        self._on = False
+        self.commands.append((time.monotonic(), "off", None))
+
+    def change_brightness(self, value, percent=True):
+        self.commands.append((time.monotonic(), "brightness", value))
+
+    def change_color(self, color="white"):
+        self.commands.append((time.monotonic(), "color", color))
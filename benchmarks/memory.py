@@ -0,0 +1,121 @@
+""" memory per tracked device, 10k synthetic devices
+
+compares the slotted device classes against a plugin style subclass that
+keeps a per instance __dict__ and against the previous device model (a
+__dict__ plus a raw_data dict duplicating the device fields), then
+measures rescans of an unchanged fleet with and without
+IOTScannerPlugin.intern_device, and without live change detection
+
+    python benchmarks/memory.py [n_devices]
+"""
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+
+from ovos_utils.messagebus import FakeBus
+
+from ovos_PHAL_plugin_commonIOT.opm.base import IOTScannerPlugin, Sensor
+
+
+class DictSensor(Sensor):
+    """ plugin device class that does not declare __slots__ """
+
+
+class LegacySensor:
+    """ replica of the device model before __slots__, for comparison """
+
+    def __init__(self, device_id, host=None, name="generic_sensor",
+                 area=None, device_type="sensor", raw_data=None):
+        self._device_type = device_type
+        self._device_id = device_id
+        self._name = name
+        self._host = host
+        self._area = area
+        self._raw = raw_data or {
+            "name": name, "host": host,
+            "area": area, "device_id": device_id}
+        self.mode = ""
+        self._timer = None
+
+
+class SyntheticScanner(IOTScannerPlugin):
+    def __init__(self, n_devices, intern=True, live_changes=True):
+        super().__init__(bus=FakeBus(), name="synthetic", config={"live_changes": live_changes})
+        self.n_devices = n_devices
+        self.intern = intern
+
+    def scan(self):
+        for i in range(self.n_devices):
+            device_id = f"sensor-{i}"
+            host = f"10.0.{i // 256}.{i % 256}"
+            if self.intern:
+                yield self.intern_device(Sensor, device_id, host=host)
+            else:
+                yield Sensor(device_id, host=host)
+
+
+def measure(build):
+    gc.collect()
+    tracemalloc.start()
+    keep = build()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del keep
+    return current, peak
+
+
+def per_device(device_cls, n):
+    current, _ = measure(lambda: [device_cls(f"sensor-{i}", host=f"10.0.{i // 256}.{i % 256}")
+                                  for i in range(n)])
+    return current / n
+
+
+def scan_cycles(n, intern, live_changes=True, cycles=5):
+    """ bytes per tracked device, then garbage collections triggered and
+    seconds spent by rescans of the unchanged fleet"""
+    scanner = SyntheticScanner(n, intern=intern, live_changes=live_changes)
+
+    def first_scan():
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            scanner.scan_once()
+        return scanner
+
+    current, _ = measure(first_scan)
+    collections = []
+
+    def count_collections(phase, info):
+        if phase == "start":
+            collections.append(info["generation"])
+
+    gc.callbacks.append(count_collections)
+    start = time.monotonic()
+    try:
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            for _ in range(cycles):
+                scanner.scan_once()
+    finally:
+        gc.callbacks.remove(count_collections)
+    return current / n, len(collections), (time.monotonic() - start) / cycles
+
+
+def main(n=10000):
+    results = {"n_devices": n,
+               "bytes_per_device_slots": per_device(Sensor, n),
+               "bytes_per_device_dict": per_device(DictSensor, n),
+               "bytes_per_device_legacy": per_device(LegacySensor, n)}
+    for mode, intern, live_changes in (("interned", True, True),
+                                       ("new_objects", False, True),
+                                       ("interned_no_live_changes", True, False)):
+        (results[f"bytes_per_tracked_device_{mode}"],
+         results[f"gc_collections_rescan_{mode}"],
+         results[f"seconds_per_rescan_{mode}"]) = scan_cycles(n, intern, live_changes)
+    print(json.dumps(results, indent=2))
+    return results
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
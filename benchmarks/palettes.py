@@ -0,0 +1,55 @@
+""" color transition microbenchmark
+
+per step interpolation with a Color allocation per step (the previous
+cross_fade / color_cycle path) against cached fade tables
+
+    python benchmarks/palettes.py [repeats]
+"""
+import json
+import sys
+import timeit
+
+from lingua_franca.util.colors import Color
+
+from ovos_PHAL_plugin_commonIOT.opm.effects import COLOR_WHEEL, fade_frames
+from ovos_PHAL_plugin_commonIOT.opm.palettes import fade_table, hsv_sweep_table
+
+
+def per_step_fade(color1, color2, steps=100):
+    r1, g1, b1 = color1
+    r2, g2, b2 = color2
+    for i in range(1, steps + 1):
+        r = r1 - int(i * float(r1 - r2) // steps)
+        g = g1 - int(i * float(g1 - g2) // steps)
+        b = b1 - int(i * float(b1 - b2) // steps)
+        Color.from_rgb(r, g, b)
+
+
+def per_step_wheel():
+    for i, color in enumerate(COLOR_WHEEL):
+        per_step_fade(color, COLOR_WHEEL[(i + 1) % len(COLOR_WHEEL)])
+
+
+def table_wheel():
+    for i, color in enumerate(COLOR_WHEEL):
+        for _ in fade_frames(color, COLOR_WHEEL[(i + 1) % len(COLOR_WHEEL)]):
+            pass
+
+
+def main(repeats=200):
+    fade_table.cache_clear()
+    results = {
+        "repeats": repeats,
+        "per_step_wheel_s": timeit.timeit(per_step_wheel, number=repeats),
+        "table_wheel_cold_s": timeit.timeit(table_wheel, number=1),
+        "table_wheel_s": timeit.timeit(table_wheel, number=repeats),
+        "hsv_sweep_table_cold_s": timeit.timeit(lambda: hsv_sweep_table.__wrapped__(360), number=1),
+        "fade_table_bytes": len(fade_table((255, 0, 0), (0, 0, 255), 100)),
+    }
+    results["speedup"] = results["per_step_wheel_s"] / results["table_wheel_s"]
+    print(json.dumps(results, indent=2))
+    return results
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
@@ -0,0 +1,127 @@
+""" concurrent registry stress test
+
+scanner threads add, change and lose devices through the manager callbacks
+while reader threads run bus queries, iterate mappings and resolve aliases,
+any exception or an inconsistent final registry fails the run
+
+    python benchmarks/registry_stress.py [scanners] [readers] [seconds]
+"""
+import json
+import logging
+import random
+import sys
+import time
+from threading import Thread, Event
+
+from ovos_utils.messagebus import FakeBus, Message
+
+from ovos_PHAL_plugin_commonIOT.device_manager import CommonIOTDeviceManager
+
+from fleet import FleetBulb, FleetSensor, AREAS
+
+MANAGER_CONFIG = {"device_cache": {"enabled": False}}
+
+
+def scanner_worker(manager, plugin, n_devices, stop, stats, seed):
+    rand = random.Random(seed)
+    devices = {}
+    while not stop.is_set():
+        i = rand.randrange(n_devices)
+        device_id = f"{plugin}-{i}"
+        action = rand.random()
+        try:
+            if device_id not in devices:
+                device_cls = FleetBulb if i % 2 else FleetSensor
+                # hosts are shared across plugins, so alias groups keep changing
+                device = device_cls(device_id, host=f"10.0.0.{i % 64}", area=rand.choice(AREAS))
+                devices[device_id] = device
+                manager.on_new_device(device, plugin)
+                stats["new"] += 1
+            elif action < 0.4:
+                manager.on_device_lost(devices.pop(device_id), plugin)
+                stats["lost"] += 1
+            else:
+                device = devices[device_id]
+                device.update(area=rand.choice(AREAS))
+                manager.on_device_changed(device, {"area": device.device_area}, plugin)
+                stats["changed"] += 1
+        except Exception as e:
+            stats["errors"].append(f"{plugin}: {e!r}")
+
+
+def reader_worker(manager, stop, stats, seed):
+    rand = random.Random(seed)
+    while not stop.is_set():
+        try:
+            kind = rand.randrange(4)
+            if kind == 0:
+                manager.bus.emit(Message("ovos.iot.get.devices",
+                                         {"area": rand.choice(AREAS), "limit": 20}))
+            elif kind == 1:
+                for device_id, aliases in manager.mappings.items():
+                    assert device_id not in aliases
+            elif kind == 2:
+                snapshot = manager.registry.snapshot()
+                for device_id in snapshot.lookup("capability", "CHANGE_COLOR"):
+                    assert snapshot.get(device_id) is not None
+            else:
+                manager.bus.emit(Message("ovos.iot.get.devices", {"capability": "turn_on"}))
+            stats["reads"] += 1
+        except Exception as e:
+            stats["errors"].append(f"reader: {e!r}")
+
+
+def check_consistency(registry):
+    """ errors found comparing the final indexes against the devices"""
+    errors = []
+    snapshot = registry.snapshot()
+    for device_id, device in snapshot.devices.items():
+        if device_id not in snapshot.lookup("host", device.host):
+            errors.append(f"{device_id} missing from host index")
+        for alias_id in snapshot.aliases(device_id):
+            if snapshot.get(alias_id).host != device.host:
+                errors.append(f"{device_id} aliased to {alias_id} on another host")
+    for idx in registry.INDEXES:
+        for key, ids in snapshot._indexes[idx].items():
+            for device_id in ids:
+                if device_id not in snapshot:
+                    errors.append(f"stale {idx} index entry {key}: {device_id}")
+    return errors
+
+
+def main(n_scanners=8, n_readers=4, seconds=5, n_devices=500):
+    manager = CommonIOTDeviceManager(FakeBus(), MANAGER_CONFIG)
+    stop = Event()
+    # one stats dict per thread, merged at the end
+    per_thread = [{"new": 0, "lost": 0, "changed": 0, "reads": 0, "errors": []}
+                  for _ in range(n_scanners + n_readers)]
+    threads = [Thread(target=scanner_worker,
+                      args=(manager, f"plugin{i}", n_devices, stop, per_thread[i], i))
+               for i in range(n_scanners)]
+    threads += [Thread(target=reader_worker,
+                       args=(manager, stop, per_thread[n_scanners + i], 1000 + i))
+                for i in range(n_readers)]
+    for t in threads:
+        t.start()
+    time.sleep(seconds)
+    stop.set()
+    for t in threads:
+        t.join()
+    manager.shutdown()
+    stats = {key: sum(s[key] for s in per_thread) if key != "errors"
+             else [e for s in per_thread for e in s["errors"]]
+             for key in per_thread[0]}
+    inconsistencies = check_consistency(manager.registry)
+    results = {"scanners": n_scanners, "readers": n_readers, "seconds": seconds,
+               "writes": stats["new"] + stats["lost"] + stats["changed"],
+               "reads": stats["reads"], "devices": len(manager.registry),
+               "errors": stats["errors"][:20], "n_errors": len(stats["errors"]),
+               "inconsistencies": inconsistencies[:20]}
+    print(json.dumps(results, indent=2))
+    return not stats["errors"] and not inconsistencies
+
+
+if __name__ == "__main__":
+    logging.disable(logging.INFO)
+    args = [int(a) for a in sys.argv[1:4]]
+    sys.exit(0 if main(*args) else 1)
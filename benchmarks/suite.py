@@ -0,0 +1,270 @@
+""" scanner, device manager and light effects benchmarks on simulated fleets
+
+runs offline against a FakeBus and prints one JSON document, save it per
+release and compare the numbers to spot regressions
+
+    python benchmarks/suite.py [--sizes 1000 10000 50000] [--churn 0.05]
+                               [--duplicates 0.1] [--output results.json]
+"""
+import argparse
+import gc
+import json
+import logging
+import os
+import platform
+import statistics
+import tempfile
+import time
+import tracemalloc
+from functools import partial
+
+from ovos_utils.messagebus import FakeBus, Message
+
+from ovos_PHAL_plugin_commonIOT.device_manager import CommonIOTDeviceManager
+from ovos_PHAL_plugin_commonIOT.opm.lights import LightGroup
+from ovos_PHAL_plugin_commonIOT.version import VERSION_MAJOR, VERSION_MINOR, VERSION_BUILD, VERSION_ALPHA
+
+from fleet import FleetScanner, RecordingBulb
+
+MANAGER_CONFIG = {"device_cache": {"enabled": False}}
+
+
+def percentiles(values):
+    if not values:
+        return {}
+    values = sorted(values)
+    pick = lambda q: values[min(len(values) - 1, int(q * len(values)))]
+    return {"p50": pick(0.5), "p95": pick(0.95), "p99": pick(0.99),
+            "max": values[-1], "mean": statistics.fmean(values)}
+
+
+def fleet(n, churn=0.0, duplicates=0.0, manager_config=None, **config):
+    """ a device manager wired to a FleetScanner, like create_scanner and
+    load_scanners do, events go through the manager's DeviceEventPipeline"""
+    manager = CommonIOTDeviceManager(FakeBus(), manager_config or MANAGER_CONFIG)
+    scanner = FleetScanner(n, churn=churn, duplicate_hosts=duplicates,
+                           bus=manager.bus, config=config)
+    scanner.new_device_callback = partial(manager.events.found, plugin="fleet")
+    scanner.lost_device_callback = partial(manager.events.lost, plugin="fleet")
+    scanner.changed_device_callback = partial(manager.events.changed, plugin="fleet")
+    manager.events.start()
+    return manager, scanner
+
+
+def bench_discovery(n, duplicates, manager_config=None):
+    """ time from the start of a cold scan until each device is registered"""
+    manager, scanner = fleet(n, duplicates=duplicates, manager_config=manager_config)
+    latencies = []
+    on_new_device = scanner.new_device_callback
+
+    def timed(dev):
+        on_new_device(dev)
+        latencies.append(time.monotonic() - start)
+
+    scanner.new_device_callback = timed
+    start = time.monotonic()
+    scanner.scan_once()
+    total = time.monotonic() - start
+    manager.shutdown()
+    return {"seconds": total, "devices_per_s": n / total,
+            "registered": len(manager.registry), "alias_groups": len(manager.mappings) // 2,
+            "latency_s": percentiles(latencies)}
+
+
+def bench_memory(n, duplicates):
+    """ bytes held per device by the scanner and the manager registry"""
+    gc.collect()
+    tracemalloc.start()
+    manager, scanner = fleet(n, duplicates=duplicates)
+    scanner.scan_once()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    manager.shutdown()
+    return {"bytes_per_device": current / n, "peak_bytes_per_device": peak / n}
+
+
+def bench_throughput(n, churn, duplicates, cycles=5, ttl=1):
+    """ new, changed and lost events handled per second under churn
+
+    ttl must be longer than a scan cycle, replaced devices expire once
+    they missed a scan for longer than that"""
+    manager, scanner = fleet(n, churn=churn, duplicates=duplicates, ttl=ttl, ttl_scans=0)
+    events = {"new": 0, "changed": 0, "lost": 0}
+    for event, attr in (("new", "new_device_callback"), ("lost", "lost_device_callback")):
+        def counted(dev, callback=getattr(scanner, attr), event=event):
+            events[event] += 1
+            callback(dev)
+        setattr(scanner, attr, counted)
+    changed_callback = scanner.changed_device_callback
+
+    def counted_changes(dev, changes):
+        events["changed"] += 1
+        changed_callback(dev, changes)
+
+    scanner.changed_device_callback = counted_changes
+    scanner.scan_once()
+    for key in events:
+        events[key] = 0
+    elapsed = 0
+    for _ in range(cycles):
+        time.sleep(scanner.ttl)  # not measured
+        scanner.churn_fleet()
+        start = time.monotonic()
+        scanner.scan_once()
+        elapsed += time.monotonic() - start
+    manager.shutdown()
+    total = sum(events.values())
+    return {"cycles": cycles, "events": events, "seconds": elapsed,
+            "events_per_s": total / elapsed if elapsed else None,
+            "scan_cycle_s": elapsed / cycles}
+
+
+def bench_queries(n, duplicates, repeats=200):
+    """ bus query latency, FakeBus dispatch included"""
+    manager, scanner = fleet(n, duplicates=duplicates)
+    scanner.scan_once()
+    responses = []
+    for msg_type in ("ovos.iot.get.devices.response", "ovos.iot.get.device.response"):
+        manager.bus.on(msg_type, responses.append)
+
+    def timed(msg_type, data):
+        start = time.monotonic()
+        manager.bus.emit(Message(msg_type, data))
+        return time.monotonic() - start
+
+    queries = {
+        "first_page": ("ovos.iot.get.devices", {}),
+        "by_type": ("ovos.iot.get.devices", {"device_type": "bulbRGB", "limit": 100}),
+        "by_area_and_type": ("ovos.iot.get.devices", {"area": "kitchen", "device_type": "bulbRGB"}),
+        "by_capability": ("ovos.iot.get.devices", {"capability": "change_color"}),
+        "fields_only": ("ovos.iot.get.devices", {"fields": ["device_id", "name"], "limit": 200}),
+        "single_device": ("ovos.iot.get.device", {"device_id": scanner.device_id(n // 2)})
+    }
+    results = {name: percentiles([timed(*query) for _ in range(repeats)])
+               for name, query in queries.items()}
+
+    # walk the whole registry page by page
+    cursor, pages = None, 0
+    start = time.monotonic()
+    while True:
+        manager.bus.emit(Message("ovos.iot.get.devices", {"cursor": cursor, "limit": 500}))
+        pages += 1
+        cursor = responses[-1].data["next_cursor"]
+        if cursor is None:
+            break
+    results["full_pagination"] = {"pages": pages, "seconds": time.monotonic() - start}
+    manager.shutdown()
+    return results
+
+
+def bench_write_read(n, duplicates, repeats=200):
+    """ latency of a registry write followed by a query, as seen by a
+    reader right after a scanner reported a change"""
+    manager, scanner = fleet(n, duplicates=duplicates)
+    scanner.scan_once()
+    registry = manager.registry
+    devices = list(registry.devices.values())[:repeats]
+    times = []
+    for i, device in enumerate(devices):
+        device.update(area=f"area {i}")
+        start = time.monotonic()
+        manager.on_device_changed(device, {"area": device.device_area}, "fleet")
+        registry.lookup("area", device.device_area)
+        times.append(time.monotonic() - start)
+    manager.shutdown()
+    return percentiles(times)
+
+
+def bench_name_resolution(n, duplicates, repeats=200):
+    """ latency of resolving spoken device references"""
+    manager, scanner = fleet(n, duplicates=duplicates)
+    scanner.scan_once()
+    utterances = {
+        "area_and_type": "the kitchen lights",
+        "exact_name": f"office lamp {n // 2 + 1 - (n // 2 + 1) % 2 + 1}",
+        "misheard_name": "the bedrom lamp 3",
+        "unknown": "the garage door"
+    }
+    results = {}
+    for name, utterance in utterances.items():
+        times = []
+        for _ in range(repeats):
+            start = time.monotonic()
+            matches = manager.resolve_device(utterance)
+            times.append(time.monotonic() - start)
+        # the first lookup scores the index, repeated ones hit the result cache
+        results[name] = {"utterance": utterance, "top_match": matches[0][0] if matches else None,
+                         "cold_s": times[0], **percentiles(times[1:])}
+    manager.shutdown()
+    return results
+
+
+def bench_effect_jitter(n_bulbs=50, duration=3, speed=0.8):
+    """ timing of effect frames as seen by the bulbs
+
+    interval jitter: deviation of the time between two frames of a bulb from
+    the effect delay, skew: spread of the same frame across all bulbs"""
+    bulbs = [RecordingBulb(f"bulb-{i}", host=f"10.1.0.{i}") for i in range(n_bulbs)]
+    group = LightGroup(bulbs)
+    group.beacon_slow(speed=speed)
+    time.sleep(duration)
+    group.stop()
+    time.sleep(0.2)  # let in flight commands land
+    expected = 1 - speed
+    jitter = []
+    frames = []
+    for bulb in bulbs:
+        times = [t for t, command, _ in bulb.commands if command == "brightness"]
+        jitter += [abs(b - a - expected) for a, b in zip(times, times[1:])]
+        frames.append(times)
+    n_frames = min(len(times) for times in frames)
+    skew = [max(times[i] for times in frames) - min(times[i] for times in frames)
+            for i in range(n_frames)]
+    return {"bulbs": n_bulbs, "frame_interval_s": expected, "frames": n_frames,
+            "interval_jitter_s": percentiles(jitter), "skew_s": percentiles(skew)}
+
+
+def main(sizes=(1000, 10000), churn=0.05, duplicates=0.1, output=None):
+    results = {
+        "version": f"{VERSION_MAJOR}.{VERSION_MINOR}.{VERSION_BUILD}a{VERSION_ALPHA}",
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": time.time(),
+        "churn": churn,
+        "duplicate_hosts": duplicates,
+        "fleets": {}
+    }
+    for n in sizes:
+        discovery = bench_discovery(n, duplicates)
+        with tempfile.TemporaryDirectory() as folder:
+            # default manager config, every event marks the device cache dirty
+            cached_config = {"device_cache": {"path": os.path.join(folder, "devices.json")}}
+            discovery_cached = bench_discovery(n, duplicates, cached_config)
+        results["fleets"][str(n)] = {
+            "discovery": discovery,
+            "discovery_with_cache": discovery_cached,
+            "memory": bench_memory(n, duplicates),
+            "throughput": bench_throughput(n, churn, duplicates,
+                                           ttl=2 * discovery["seconds"] + 0.05),
+            "queries": bench_queries(n, duplicates),
+            "write_read": bench_write_read(n, duplicates),
+            "name_resolution": bench_name_resolution(n, duplicates)
+        }
+    results["effect_jitter"] = bench_effect_jitter()
+    text = json.dumps(results, indent=2)
+    if output:
+        with open(output, "w") as f:
+            f.write(text)
+    print(text)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0].strip())
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--churn", type=float, default=0.05)
+    parser.add_argument("--duplicates", type=float, default=0.1)
+    parser.add_argument("--output")
+    args = parser.parse_args()
+    logging.disable(logging.INFO)  # one log line per device otherwise
+    main(args.sizes, args.churn, args.duplicates, args.output)
@@ -0,0 +1,169 @@
+import importlib
+import json
+import os
+import tempfile
+import time
+from threading import Thread, Condition, Lock
+
+from ovos_config.locations import get_xdg_data_save_path
+from ovos_utils.log import LOG
+
+from ovos_PHAL_plugin_commonIOT.opm.base import IOTAbstractDevice, IOTDeviceType, json_ready
+
+
+class DeviceCache:
+    """ on disk copy of the device registry, used for warm startup
+
+    devices are saved as JSON entries, writes go to a temporary file that
+    replaces the cache atomically, so a crash never leaves a partial file
+
+    changes only mark the cache dirty, a single saver thread writes it once
+    no change arrived for save_delay seconds, or max_delay seconds after
+    the first unsaved change while changes keep coming"""
+
+    def __init__(self, path=None, save_delay=5, max_age=7 * 24 * 3600, max_delay=60):
+        self.path = path or os.path.join(get_xdg_data_save_path(), "iot", "devices.json")
+        self.save_delay = save_delay  # seconds, bursts of changes are saved once
+        self.max_delay = max_delay  # seconds, upper bound for a pending save
+        self.max_age = max_age  # seconds, older entries are not restored
+        self._lock = Lock()
+        self._entries = None  # plugin -> [entry] read from disk, not restored yet
+        self._cond = Condition()
+        self._saver = None
+        self._get_devices = None
+        self._first_change = None  # monotonic, None when nothing is pending
+        self._last_change = None
+
+    @staticmethod
+    def serialize(device: IOTAbstractDevice, plugin=None):
+        return {
+            "device_id": device.device_id,
+            "plugin": plugin,
+            "device_class": f"{device.__class__.__module__}:{device.__class__.__qualname__}",
+            "device_type": json_ready(device.device_type),
+            "host": device.host,
+            "name": device.name,
+            "area": json_ready(device.device_area),
+            "raw_data": json_ready(device._raw) if device._raw is not None else None,
+            "last_seen": device.last_seen
+        }
+
+    @staticmethod
+    def deserialize(entry):
+        """ rebuild a device object from a cache entry, None if not possible"""
+        try:
+            module, qualname = entry["device_class"].split(":")
+            clazz = importlib.import_module(module)
+            for attr in qualname.split("."):
+                clazz = getattr(clazz, attr)
+            device = clazz(entry["device_id"], host=entry.get("host"),
+                           name=entry.get("name"), area=entry.get("area"),
+                           raw_data=entry.get("raw_data"))
+            if entry.get("device_type") in IOTDeviceType._value2member_map_:
+                device.update(device_type=IOTDeviceType(entry["device_type"]))
+            device.last_seen = entry.get("last_seen")
+        except Exception as e:
+            LOG.debug(f"can not restore cached device {entry.get('device_id')}: {e}")
+            return None
+        return device
+
+    def _read(self):
+        """ read the cache file once, entries are only parsed, nothing is imported"""
+        with self._lock:
+            if self._entries is not None:
+                return
+            self._entries = {}
+            try:
+                with open(self.path) as f:
+                    entries = json.load(f)
+                if not isinstance(entries, list) or \
+                        not all(isinstance(entry, dict) for entry in entries):
+                    raise ValueError("expected a list of device entries")
+                now = time.time()
+                cached = {}
+                for entry in entries:
+                    if not isinstance(entry.get("device_id"), str):
+                        continue
+                    if self.max_age and now - (entry.get("last_seen") or 0) > self.max_age:
+                        continue
+                    cached.setdefault(entry.get("plugin"), []).append(entry)
+            except FileNotFoundError:
+                return
+            except Exception as e:
+                LOG.error(f"ignoring corrupted device cache {self.path}: {e}")
+                return
+            self._entries = cached
+
+    def load(self, plugin):
+        """ cached devices of a plugin, each plugin is restored only once
+
+        imports the plugin device classes, call it where the plugin itself
+        is being loaded"""
+        self._read()
+        with self._lock:
+            entries = self._entries.pop(plugin, [])
+        return [device for device in map(self.deserialize, entries) if device is not None]
+
+    def save(self, devices):
+        """ write [(device, plugin)] to disk, replaces the previous cache
+
+        entries of plugins not restored yet are kept as they were"""
+        self._read()
+        entries = [self.serialize(device, plugin) for device, plugin in devices]
+        folder = os.path.dirname(self.path)
+        with self._lock:
+            known = {entry["device_id"] for entry in entries}
+            entries += [entry for pending in self._entries.values() for entry in pending
+                        if entry["device_id"] not in known]
+            os.makedirs(folder, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=folder, prefix=".devices-", suffix=".json")
+            try:
+                with os.fdopen(fd, "w") as f:
+                    json.dump(entries, f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp, self.path)
+            except Exception:
+                os.unlink(tmp)
+                raise
+
+    def schedule_save(self, get_devices):
+        """ mark the cache dirty, get_devices() is saved by the saver thread"""
+        now = time.monotonic()
+        with self._cond:
+            self._get_devices = get_devices
+            self._last_change = now
+            if self._first_change is None:
+                self._first_change = now
+                self._cond.notify()
+            if self._saver is None:
+                self._saver = Thread(target=self._save_loop, daemon=True,
+                                     name="iot-device-cache")
+                self._saver.start()
+
+    def _save_loop(self):
+        while True:
+            with self._cond:
+                while self._first_change is None:
+                    self._cond.wait()
+                due = min(self._last_change + self.save_delay,
+                          self._first_change + self.max_delay)
+                now = time.monotonic()
+                if due > now:
+                    self._cond.wait(due - now)
+                    continue
+                self._first_change = None
+                get_devices = self._get_devices
+            self._save_now(get_devices)
+
+    def _save_now(self, get_devices):
+        try:
+            self.save(get_devices())
+        except Exception as e:
+            LOG.error(f"failed to save device cache {self.path}: {e}")
+
+    def flush(self, get_devices):
+        """ cancel any pending save and write immediately"""
+        with self._cond:
+            self._first_change = None
+        self._save_now(get_devices)
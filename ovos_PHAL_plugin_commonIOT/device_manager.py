@@ -1,31 +1,126 @@
-from pprint import pprint
+import asyncio
+import threading
+import time
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import partial
+from queue import Full
 
-from ovos_PHAL_plugin_commonIOT.opm import find_iot_plugins
-from ovos_PHAL_plugin_commonIOT.opm.base import IOTAbstractDevice
+from ovos_utils.log import LOG
+from ovos_utils.messagebus import Message
+
+from ovos_PHAL_plugin_commonIOT.cache import DeviceCache
+from ovos_PHAL_plugin_commonIOT.events import DeviceEventPipeline
+from ovos_PHAL_plugin_commonIOT.name_index import DeviceNameIndex
+from ovos_PHAL_plugin_commonIOT.opm import find_iot_entry_points
+from ovos_PHAL_plugin_commonIOT.opm.aio import get_device_loop
+from ovos_PHAL_plugin_commonIOT.opm.base import IOTAbstractDevice, json_ready
+from ovos_PHAL_plugin_commonIOT.opm.commands import get_command_dispatcher
+from ovos_PHAL_plugin_commonIOT.opm.effects import get_effects_engine
+from ovos_PHAL_plugin_commonIOT.opm.metrics import METRICS
+from ovos_PHAL_plugin_commonIOT.registry import DeviceRegistry
+from ovos_PHAL_plugin_commonIOT.scheduler import ScanScheduler
+from ovos_PHAL_plugin_commonIOT.supervisor import ScannerSupervisor
+
+ACTION_SECONDS = METRICS.histogram("action_seconds", "bus device actions, all targets included",
+                                   ("action",))
+ACTION_ERRORS = METRICS.counter("action_errors", "failed device actions, per target device",
+                                ("action", "error"))
 
 
 class CommonIOTDeviceManager:
-    def __init__(self, bus):
+    # bus action -> (device method or property, message.data keys passed as args)
+    DEVICE_ACTIONS = {
+        "turn_on": ("turn_on", ()),
+        "turn_off": ("turn_off", ()),
+        "toggle": ("toggle", ()),
+        "get.power.state": ("is_on", ()),
+        "refresh": ("refresh_state", ()),
+        "get.brightness": ("brightness", ()),
+        "set.brightness": ("change_brightness", ("brightness",)),
+        "set.color": ("change_color", ("color",)),
+        "pause": ("pause", ()),
+        "resume": ("resume", ()),
+        "stop": ("stop", ()),
+        "next": ("play_next", ()),
+        "prev": ("play_prev", ())
+    }
+
+    def __init__(self, bus, config=None):
         """
             Args:
                 bus (MycroftBusClient): The Mycroft bus client
+                config (dict): The plugin configuration
         """
+        self.config = config or {}
         self.scanners = {}
-        self.devices = {}
-        self.mappings = {}
+        self.load_times = {}  # plugin -> seconds spent importing and creating it
+        self._loading = {}  # plugin -> Future of a scanner loading in background
+        self._loading_lock = threading.Lock()
+        self._entry_points = {}  # plugin -> EntryPoint, kept for restarts
+        self.registry = DeviceRegistry()
+        self.name_index = DeviceNameIndex(min_similarity=self.config.get("min_name_similarity", 0.5))
+        self.tentative = set()  # restored from cache, not yet seen by a scanner
         self.bus = bus
+        scheduler_config = self.config.get("scheduler", {})
+        self.scheduler = ScanScheduler(
+            max_workers=scheduler_config.get("max_workers", 4),
+            max_concurrent=scheduler_config.get("max_concurrent", 2),
+            jitter=scheduler_config.get("jitter", 0.2))
+
+        get_command_dispatcher().configure(
+            max_rate=self.config.get("max_command_rate"),
+            max_pending=self.config.get("max_pending_commands"),
+            command_timeout=self.config.get("command_timeout"))
+        self.loader_executor = ThreadPoolExecutor(
+            max_workers=self.config.get("loader_workers", 4),
+            thread_name_prefix="iot-loader")
+        supervisor_config = self.config.get("supervisor", {})
+        self.supervisor = ScannerSupervisor(
+            self,
+            interval=supervisor_config.get("interval", 10),
+            backoff=supervisor_config.get("backoff", 5),
+            max_backoff=supervisor_config.get("max_backoff", 300),
+            max_scan_failures=supervisor_config.get("max_scan_failures", 5),
+            stall_factor=supervisor_config.get("stall_factor", 5),
+            max_scan_time=supervisor_config.get("max_scan_time", 300))
+
+        # scanner events go through the pipeline, flapping devices are
+        # debounced and the bus gets rate capped batches
+        events_config = self.config.get("events", {})
+        self.events = DeviceEventPipeline(
+            self,
+            lost_grace=events_config.get("lost_grace", 10),
+            max_lost_grace=events_config.get("max_lost_grace", 120))
+        self.events.subscribe(self.emit_device_events, name="bus",
+                              max_rate=events_config.get("max_rate", 2),
+                              batch_window=events_config.get("batch_window", 0.5))
+
+        # devices known from the last run, restored while scanners load
+        cache_config = self.config.get("device_cache", {})
+        self.cache = None
+        if cache_config.get("enabled", True):
+            self.cache = DeviceCache(path=cache_config.get("path"),
+                                     save_delay=cache_config.get("save_delay", 5),
+                                     max_delay=cache_config.get("max_delay", 60),
+                                     max_age=cache_config.get("max_age", 7 * 24 * 3600))
 
         # BUS API
-        # self.bus.on("ovos.iot.get.devices", self.handle_get_devices)
-        # self.bus.on("ovos.iot.get.device", self.handle_get_device)
+        self.bus.on("ovos.iot.get.devices", self.handle_get_devices)
+        self.bus.on("ovos.iot.get.device", self.handle_get_device)
+        self.bus.on("ovos.iot.get.scanners", self.handle_get_scanners)
+        self.bus.on("ovos.iot.get.metrics", self.handle_get_metrics)
+        self.bus.on("ovos.iot.resolve.device", self.handle_resolve_device)
+        self._register_gauges()
 
-        # generic device actions
-        # self.bus.on("ovos.iot.device.turn_on", self.handle_turn_on)
-        # self.bus.on("ovos.iot.device.turn_off", self.handle_turn_off)
+        # device actions, target a single "device_id" or a selector
+        # (device_ids, device_type, area, capability, plugin)
+        for action in self.DEVICE_ACTIONS:
+            self.bus.on(f"ovos.iot.device.{action}",
+                        partial(self.handle_device_action, action=action))
         # self.bus.on("ovos.iot.device.sleep", self.handle_sleep)
         # self.bus.on("ovos.iot.device.wakeup", self.handle_wakeup)
         # self.bus.on("ovos.iot.device.reboot", self.handle_reboot)
-        # self.bus.on("ovos.iot.device.get.power.state", self.handle_get_power_state)
 
         # iot media player actions
         # self.bus.on("ovos.iot.device.get.volume", self.handle_get_volume)
@@ -35,43 +130,414 @@ class CommonIOTDeviceManager:
         # self.bus.on("ovos.iot.device.mute", self.handle_mute)
         # self.bus.on("ovos.iot.device.unmute", self.handle_unmute)
 
-    def disambiguate_new_device(self, device: IOTAbstractDevice):
-        # check if device with same ip exists
-        for dev_id, device2 in self.devices.items():
-            if device.host == device2.host:
-                print("duplicate device found, same host", device, device2)
-                if device.device_id not in self.mappings:
-                    self.mappings[device.device_id] = []
-                if device2.device_id not in self.mappings[device.device_id]:
-                    self.mappings[device.device_id].append(device2.device_id)
-
-                if device2.device_id not in self.mappings:
-                    self.mappings[device2.device_id] = []
-                if device.device_id not in self.mappings[device2.device_id]:
-                    self.mappings[device2.device_id].append(device.device_id)
-
-    def on_new_device(self, device: IOTAbstractDevice):
-        self.disambiguate_new_device(device)
-        pprint(device.as_dict)
-        self.devices[device.device_id] = device
-
-    def on_device_lost(self, device: IOTAbstractDevice):
-        pprint(device.as_dict)
-        if device.device_id in self.devices:
-            self.devices.pop(device.device_id)
+    @property
+    def devices(self):
+        return self.registry.devices
+
+    @property
+    def mappings(self):
+        return self.registry.mappings
+
+    def disambiguate_new_device(self, device: IOTAbstractDevice, plugin=None):
+        # register device, devices with same host are grouped as aliases
+        aliases = self.registry.add(device, plugin)
+        if aliases:
+            LOG.debug(f"duplicate device found, same host {device.device_id}: {sorted(aliases)}")
+
+    def index_device_names(self, device: IOTAbstractDevice, plugin=None, scanner=None):
+        """ (re)index the names a device can be called by"""
+        scanner = scanner or self.scanners.get(plugin)
+        aliases = None
+        if scanner is not None and scanner.aliases:
+            aliases = scanner.aliases.get(device.device_id) or scanner.aliases.get(device.name)
+        self.name_index.add(device, aliases)
+
+    def restore_devices(self, plugin, scanner):
+        """ register the cached devices of a plugin as tentatively present"""
+        if self.cache is None:
+            return
+        for device in self.cache.load(plugin):
+            scanner.adopt(device)
+            if scanner.is_tentative(device.device_id):
+                self.registry.add(device, plugin)
+                self.index_device_names(device, plugin, scanner)
+                self.tentative.add(device.device_id)
+
+    def cached_devices(self):
+        return [(device, self.registry.plugin_of(device_id))
+                for device_id, device in list(self.registry.devices.items())]
+
+    def save_cache(self):
+        if self.cache is not None:
+            self.cache.schedule_save(self.cached_devices)
+
+    def on_new_device(self, device: IOTAbstractDevice, plugin=None):
+        self.tentative.discard(device.device_id)
+        self.disambiguate_new_device(device, plugin)
+        self.index_device_names(device, plugin)
+        LOG.debug(f"new device: {device.device_id}")
+        self.save_cache()
+
+    def on_device_lost(self, device: IOTAbstractDevice, plugin=None):
+        LOG.debug(f"lost device: {device.device_id}")
+        self.tentative.discard(device.device_id)
+        self.registry.remove(device.device_id)
+        self.name_index.remove(device.device_id)
+        self.save_cache()
+
+    def on_device_changed(self, device: IOTAbstractDevice, changes, plugin=None):
+        # re-index, host/area/name may have changed
+        self.registry.add(device, plugin)
+        if not self.name_index.is_current(device):
+            self.index_device_names(device, plugin)
+        self.save_cache()
+
+    def emit_device_events(self, events):
+        self.bus.emit(Message("ovos.iot.devices.changed", {"events": events}))
+
+    # device queries
+    def serialize_device(self, device_id):
+        """ bus payload for a device, built from its cached snapshot"""
+        device = self.registry.get(device_id)
+        if device is None:
+            return None
+        return {**device.snapshot,
+                "device_id": device_id,
+                "plugin": self.registry.plugin_of(device_id),
+                "capabilities": list(self.registry.capabilities_of(device_id)),
+                "aliases": sorted(self.registry.aliases(device_id)),
+                "tentative": device_id in self.tentative}
+
+    def select_devices(self, device_type=None, area=None, capability=None,
+                       plugin=None, device_ids=None):
+        """ sorted device_ids matching every given filter"""
+        candidates = None
+        for index, key in (("device_type", device_type),
+                           ("area", area),
+                           ("plugin", plugin)):
+            if key is None:
+                continue
+            ids = self.registry.lookup(index, key)
+            candidates = ids if candidates is None else candidates & ids
+        if device_ids is not None:
+            ids = {dev_id for dev_id in device_ids if dev_id in self.registry}
+            candidates = ids if candidates is None else candidates & ids
+        if capability is not None:
+            # a name or a list of names, devices must have all of them
+            for name in [capability] if isinstance(capability, str) else capability:
+                ids = self.registry.lookup("capability", name.upper())
+                candidates = ids if candidates is None else candidates & ids
+        if candidates is None:
+            return self.registry.sorted_ids()
+        return sorted(candidates)
+
+    def handle_get_devices(self, message):
+        """ list devices
+
+        message.data may contain any filter accepted by select_devices,
+        "cursor" (device_id of the last entry of the previous page),
+        "limit" (page size) and "fields" (keys to include per device)"""
+        limit = message.data.get("limit") or self.config.get("page_size", 50)
+        try:
+            limit = max(1, int(limit))
+        except (TypeError, ValueError):
+            self.bus.emit(message.response({"devices": [], "total": 0, "next_cursor": None,
+                                            "error": f"invalid limit: {limit!r}"}))
+            return
+        ids = self.select_devices(device_type=message.data.get("device_type"),
+                                  area=message.data.get("area"),
+                                  capability=message.data.get("capability"),
+                                  plugin=message.data.get("plugin"),
+                                  device_ids=message.data.get("device_ids"))
+        cursor = message.data.get("cursor")
+        start = bisect_right(ids, cursor) if cursor is not None else 0
+        page = ids[start:start + limit]
+        fields = message.data.get("fields")
+        devices = []
+        for device_id in page:
+            payload = self.serialize_device(device_id)
+            if fields:
+                payload = {k: payload.get(k) for k in fields}
+            devices.append(payload)
+        next_cursor = page[-1] if start + limit < len(ids) else None
+        self.bus.emit(message.response({"devices": devices,
+                                        "total": len(ids),
+                                        "next_cursor": next_cursor}))
+
+    def handle_get_device(self, message):
+        device_id = message.data.get("device_id")
+        payload = self.serialize_device(device_id)
+        if payload is None:
+            self.bus.emit(message.response({"device_id": device_id,
+                                            "device": None,
+                                            "error": "device not found"}))
+            return
+        fields = message.data.get("fields")
+        if fields:
+            payload = {k: payload.get(k) for k in fields}
+        self.bus.emit(message.response({"device_id": device_id,
+                                        "device": payload}))
+
+    def resolve_device(self, utterance, limit=5):
+        """ [(device_id, score)] of the devices an utterance refers to"""
+        return self.name_index.resolve(utterance, limit)
+
+    def handle_resolve_device(self, message):
+        matches = self.resolve_device(message.data.get("utterance", ""),
+                                      message.data.get("limit", 5))
+        self.bus.emit(message.response({"matches": [{"device_id": device_id, "score": score}
+                                                    for device_id, score in matches]}))
+
+    def handle_get_scanners(self, message):
+        self.bus.emit(message.response({"scanners": self.supervisor.report()}))
+
+    # metrics
+    def _register_gauges(self):
+        def devices_by_plugin_and_type():
+            counts = {}
+            for device_id, device in list(self.registry.devices.items()):
+                key = (self.registry.plugin_of(device_id), json_ready(device.device_type))
+                counts[key] = counts.get(key, 0) + 1
+            return counts
+
+        def queue_depths():
+            return {
+                ("commands",): get_command_dispatcher().pending_count,
+                ("device_loop",): get_device_loop().executor._work_queue.qsize(),
+                ("scans",): self.scheduler.executor._work_queue.qsize(),
+                ("loader",): self.loader_executor._work_queue.qsize()
+            }
+
+        METRICS.gauge("devices", "registered devices", ("plugin", "device_type"),
+                      callback=devices_by_plugin_and_type)
+        METRICS.gauge("tentative_devices", "devices restored from cache, not seen yet",
+                      callback=lambda: len(self.tentative))
+        METRICS.gauge("queue_depth", "pending work items", ("queue",), callback=queue_depths)
+        METRICS.gauge("threads", "live threads in the process", callback=threading.active_count)
+        METRICS.gauge("light_effects", "running light effects",
+                      callback=lambda: len(set(get_effects_engine()._owners.values())))
+
+    def handle_get_metrics(self, message):
+        """ metrics snapshot, "format": "prometheus" returns the text format"""
+        if message.data.get("format") == "prometheus":
+            self.bus.emit(message.response({"format": "prometheus",
+                                            "text": METRICS.prometheus()}))
+        else:
+            self.bus.emit(message.response({"metrics": METRICS.collect()}))
+
+    # device actions
+    async def _async_run_action(self, device, method, args, deadline=None):
+        start = time.monotonic()
+        try:
+            if callable(getattr(type(device), method, None)):
+                # commands go through the device queue, ordered with effects
+                dispatcher = get_command_dispatcher()
+                try:
+                    future = dispatcher.submit(device, method, *args, timeout=0)
+                except Full:
+                    # wait for room in a worker thread, async devices drain
+                    # their queue on this loop, blocking it would deadlock
+                    timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+                    future = await asyncio.get_running_loop().run_in_executor(
+                        None, partial(dispatcher.submit, device, method, *args, timeout=timeout))
+                result = await asyncio.wrap_future(future)
+                device.invalidate_snapshot()
+            else:  # state read, eg. is_on, may query the device
+                result = await asyncio.get_running_loop().run_in_executor(
+                    None, getattr, device, method)
+            return {"success": True, "result": json_ready(result),
+                    "latency": time.monotonic() - start}
+        except Exception as e:
+            return {"success": False, "error": repr(e),
+                    "latency": time.monotonic() - start}
+
+    async def async_run_action(self, device_ids, action, data=None, timeout=None):
+        """ run an action on many devices concurrently from one event loop
+
+        devices not done after timeout seconds (action_timeout by default)
+        are reported as "timeout", their commands are cancelled unless
+        already sent, returns per device results with success,
+        result/error and latency"""
+        data = data or {}
+        timeout = timeout or self.config.get("action_timeout", 10)
+        method, arg_keys = self.DEVICE_ACTIONS[action]
+        args = [data[k] for k in arg_keys if k in data]
+        deadline = time.monotonic() + timeout
+        tasks = {}
+        results = {}
+        for device_id in device_ids:
+            device = self.registry.get(device_id)
+            if device is None:
+                results[device_id] = {"success": False, "error": "device not found"}
+                continue
+            tasks[device_id] = asyncio.ensure_future(
+                self._async_run_action(device, method, args, deadline))
+        if tasks:
+            await asyncio.wait(tasks.values(), timeout=timeout)
+
+        for device_id, task in tasks.items():
+            if task.done():
+                results[device_id] = task.result()
+            else:
+                task.cancel()
+                results[device_id] = {"success": False, "error": "timeout"}
+        return results
+
+    def run_action(self, device_ids, action, data=None, timeout=None):
+        """ blocking async_run_action, runs on the shared device loop"""
+        return get_device_loop().run_sync(
+            self.async_run_action(device_ids, action, data, timeout))
+
+    def handle_device_action(self, message, action):
+        data = message.data
+        if data.get("device_id"):
+            device_ids = [data["device_id"]]
+        elif any(data.get(k) is not None for k in
+                 ("device_ids", "device_type", "area", "capability", "plugin")):
+            device_ids = self.select_devices(device_type=data.get("device_type"),
+                                             area=data.get("area"),
+                                             capability=data.get("capability"),
+                                             plugin=data.get("plugin"),
+                                             device_ids=data.get("device_ids"))
+        else:
+            self.bus.emit(message.response({"action": action,
+                                            "error": "no devices selected"}))
+            return
+
+        start = time.monotonic()
+        results = self.run_action(device_ids, action, data)
+        ACTION_SECONDS.observe(time.monotonic() - start, action=action)
+        for result in results.values():
+            if not result["success"]:
+                ACTION_ERRORS.inc(action=action, error=result["error"].split("(")[0])
+        self.bus.emit(message.response({
+            "action": action,
+            "success": bool(results) and all(r["success"] for r in results.values()),
+            "results": results,
+            "latency": time.monotonic() - start
+        }))
+
+    def plugin_config(self, plugin):
+        return self.config.get("scanners", {}).get(plugin, {})
 
     def load_scanners(self):
-        for plugin, scanner_clazz in find_iot_plugins().items():
-            try:
-                scanner = scanner_clazz(self.bus,
-                                        new_device_callback=self.on_new_device,
-                                        lost_device_callback=self.on_device_lost)
-                print(f"loaded {plugin}")
-            except:
-                print(f"{plugin} failed to load")
+        """ import and start every enabled scanner plugin in the background
+
+        returns immediately, see wait_for_scanners"""
+        if not self.config.get("use_threads", False) and not self.scheduler.is_alive():
+            self.scheduler.start()
+        if not self.supervisor.is_alive():
+            self.supervisor.start()
+        if not self.events.is_alive():
+            self.events.start()
+        for plugin, entry_point in find_iot_entry_points().items():
+            if not self.plugin_config(plugin).get("enabled", True):
+                LOG.info(f"{plugin} disabled")
+                continue
+            if plugin in self.scanners or plugin in self._loading:
                 continue
+            self._entry_points[plugin] = entry_point
+            self.supervisor.health_of(plugin)
+            self._submit_load(plugin, entry_point)
+
+    def wait_for_scanners(self, timeout=None):
+        """ block until every scanner plugin finished loading"""
+        wait(list(self._loading.values()), timeout=timeout)
+
+    def _submit_load(self, plugin, entry_point, previous=None):
+        # the worker pops the entry under the same lock, never before it is set
+        with self._loading_lock:
+            self._loading[plugin] = self.loader_executor.submit(
+                self._load_scanner, plugin, entry_point, previous)
+
+    def _load_finished(self, plugin):
+        with self._loading_lock:
+            self._loading.pop(plugin, None)
+
+    def _load_scanner(self, plugin, entry_point, previous=None):
+        start = time.monotonic()
+        try:
+            scanner_clazz = entry_point.load()
+            scanner = self.create_scanner(plugin, scanner_clazz, previous)
+        except Exception as e:
+            LOG.exception(f"{plugin} failed to load")
+            self._load_finished(plugin)
+            self.supervisor.scanner_failed(plugin, e)
+            return None
+        self.load_times[plugin] = time.monotonic() - start
+        LOG.info(f"loaded {plugin} in {self.load_times[plugin]:.2f}s")
+        self.start_scanner(plugin, scanner)
+        self._load_finished(plugin)
+        self.supervisor.scanner_started(plugin, self.load_times[plugin])
+        self.bus.emit(Message("ovos.iot.scanner.loaded",
+                              {"plugin": plugin,
+                               "load_time": self.load_times[plugin]}))
+        return scanner
+
+    def create_scanner(self, plugin, scanner_clazz, previous=None):
+        """ previous is a failed scanner being replaced, its devices were
+        already announced, they are kept until the new scanner expires them"""
+        scanner = scanner_clazz(self.bus,
+                                new_device_callback=partial(self.events.found, plugin=plugin),
+                                lost_device_callback=partial(self.events.lost, plugin=plugin))
+        # not a constructor kwarg, older plugins do not accept it
+        scanner.changed_device_callback = partial(self.events.changed, plugin=plugin)
+        plugin_config = self.plugin_config(plugin)
+        if plugin_config:
+            scanner.update_config(plugin_config)
+        self.restore_devices(plugin, scanner)
+        if previous is not None:
+            for device in list(previous.timestamps.values()):
+                scanner.adopt(device, tentative=False)
+        return scanner
+
+    def start_scanner(self, plugin, scanner):
+        # by default all scanners share a single event loop,
+        # "use_threads" falls back to one thread per scanner
+        if self.config.get("use_threads", False):
             scanner.start()
-            self.scanners[plugin] = scanner
+        else:
+            self.scheduler.add(plugin, scanner)
+        self.scanners[plugin] = scanner
+
+    def scanner_alive(self, plugin):
+        scanner = self.scanners.get(plugin)
+        if scanner is None:
+            return False
+        if self.config.get("use_threads", False):
+            return scanner.is_alive()
+        return self.scheduler.is_running(plugin)
+
+    def stop_scanner(self, plugin):
+        """ unschedule a scanner, a thread ends after its current scan,
+        a stuck one is detached from the manager"""
+        scanner = self.scanners.pop(plugin, None)
+        if scanner is None:
+            return None
+        if self.config.get("use_threads", False):
+            scanner.stop()
+        else:
+            self.scheduler.remove(plugin)
+        scanner.new_device_callback = None
+        scanner.lost_device_callback = None
+        scanner.changed_device_callback = None
+        return scanner
+
+    def restart_scanner(self, plugin):
+        """ replace a scanner with a fresh instance, loaded in the background"""
+        if plugin in self._loading or plugin not in self._entry_points:
+            return
+        previous = self.stop_scanner(plugin)
+        self._submit_load(plugin, self._entry_points[plugin], previous)
+
+    def shutdown(self):
+        self.supervisor.stop()
+        self.events.stop()
+        if self.scheduler.is_alive():
+            self.scheduler.stop()
+        self.loader_executor.shutdown(wait=False)
+        if self.cache is not None:
+            self.cache.flush(self.cached_devices)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,236 @@
+import heapq
+import time
+from threading import Thread, Event, Condition, RLock
+
+from ovos_utils.log import LOG
+
+from ovos_PHAL_plugin_commonIOT.opm.base import IOTAbstractDevice, json_ready
+from ovos_PHAL_plugin_commonIOT.opm.metrics import METRICS
+
+EVENTS_DEBOUNCED = METRICS.counter("device_events_debounced",
+                                   "lost devices found again within the grace period",
+                                   ("plugin",))
+EVENTS_COALESCED = METRICS.counter("device_events_coalesced",
+                                   "device events merged into a pending one", ("subscriber",))
+EVENT_BATCHES = METRICS.counter("device_event_batches", "device event batches delivered",
+                                ("subscriber",))
+
+
+def coalesce(previous, event):
+    """ merge a device event into the one pending for the same device
+
+    returns None when both cancel out, eg. a device found and lost again
+    before subscribers heard about it"""
+    if previous is None:
+        return event
+    kinds = (previous["event"], event["event"])
+    if kinds == ("found", "lost"):
+        return None
+    if kinds == ("found", "changed"):
+        return {**event, "event": "found", "changes": {}}
+    if kinds == ("changed", "changed"):
+        return {**event, "changes": {**previous["changes"], **event["changes"]}}
+    if kinds == ("lost", "found"):
+        # subscribers knew the device before the batch and it is still there
+        return {**event, "event": "changed"}
+    return event
+
+
+class EventSubscriber:
+    """ receives coalesced batches of device events
+
+    events pile up for batch_window seconds after the first one, a batch
+    is never delivered less than 1 / max_rate seconds after the previous
+    one, everything arriving meanwhile is merged per device"""
+
+    def __init__(self, callback, name=None, max_rate=None, batch_window=0.5):
+        self.callback = callback
+        self.name = name or getattr(callback, "__name__", "subscriber")
+        self.max_rate = max_rate
+        self.batch_window = batch_window
+        self.pending = {}  # device_id -> coalesced event
+        self.first_pending = None  # monotonic
+        self.last_delivery = None  # monotonic
+
+    def push(self, event, now):
+        device_id = event["device_id"]
+        previous = self.pending.pop(device_id, None)
+        if previous is not None:
+            EVENTS_COALESCED.inc(subscriber=self.name)
+        merged = coalesce(previous, event)
+        if merged is not None:
+            self.pending[device_id] = merged
+        if not self.pending:
+            self.first_pending = None
+        elif self.first_pending is None:
+            self.first_pending = now
+
+    def due(self):
+        """ monotonic time the next batch may be delivered, None if idle"""
+        if not self.pending:
+            return None
+        due = self.first_pending + self.batch_window
+        if self.max_rate and self.last_delivery is not None:
+            due = max(due, self.last_delivery + 1 / self.max_rate)
+        return due
+
+    def take(self, now):
+        events = list(self.pending.values())
+        self.pending = {}
+        self.first_pending = None
+        self.last_delivery = now
+        return events
+
+
+class DeviceEventPipeline(Thread):
+    """ sits between the scanners and the device manager
+
+    found and changed devices are registered right away, a lost device stays
+    registered for lost_grace seconds and the loss is dropped if a scanner
+    finds it again meanwhile, every time a device does this its grace
+    period grows by lost_grace up to max_lost_grace, so a phone drifting in
+    and out of bluetooth range stops generating events
+
+    subscribers get the events in rate capped batches, the bus subscriber
+    emits them as a single "ovos.iot.devices.changed" message per batch"""
+
+    def __init__(self, manager, lost_grace=10, max_lost_grace=120):
+        super().__init__(daemon=True)
+        self.manager = manager
+        self.lost_grace = lost_grace
+        self.max_lost_grace = max_lost_grace
+        self.subscribers = []
+        self._lost = {}  # device_id -> (deadline, device, plugin)
+        self._deadlines = []  # min-heap of (deadline, device_id)
+        self._flaps = {}  # device_id -> times it was found again while lost
+        self._wakeup = Condition()
+        # serializes finding a device against confirming its loss, taken
+        # before _wakeup, manager callbacks run while holding it
+        self._presence = RLock()
+        self._stopped = Event()
+
+    def subscribe(self, callback, name=None, max_rate=None, batch_window=0.5):
+        """ callback(events) is called with lists of coalesced event dicts,
+        "device_id", "plugin", "event" (found, lost or changed) and "changes" """
+        subscriber = EventSubscriber(callback, name, max_rate, batch_window)
+        with self._wakeup:
+            self.subscribers.append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._wakeup:
+            if subscriber in self.subscribers:
+                self.subscribers.remove(subscriber)
+
+    def publish(self, event, device_id, plugin, changes=None):
+        event = {"device_id": device_id, "plugin": plugin, "event": event,
+                 "changes": json_ready(changes or {})}
+        now = time.monotonic()
+        with self._wakeup:
+            for subscriber in self.subscribers:
+                subscriber.push(event, now)
+            self._wakeup.notify()
+
+    # scanner callbacks
+    def found(self, device: IOTAbstractDevice, plugin=None):
+        with self._presence:
+            with self._wakeup:
+                pending = self._lost.pop(device.device_id, None)
+                if pending is not None:
+                    self._flaps[device.device_id] = self._flaps.get(device.device_id, 0) + 1
+            self.manager.on_new_device(device, plugin)
+            if pending is None:
+                self.publish("found", device.device_id, plugin)
+                return
+        EVENTS_DEBOUNCED.inc(plugin=plugin)
+        old, new = pending[1].snapshot, device.snapshot
+        changes = {k: v for k, v in new.items() if old.get(k) != v}
+        if changes:
+            self.publish("changed", device.device_id, plugin, changes)
+
+    def lost(self, device: IOTAbstractDevice, plugin=None):
+        if not self.lost_grace:
+            with self._presence:
+                self._confirm_lost(device, plugin)
+            return
+        with self._wakeup:
+            flaps = self._flaps.get(device.device_id, 0)
+            grace = min(self.lost_grace * (1 + flaps), self.max_lost_grace)
+            deadline = time.monotonic() + grace
+            self._lost[device.device_id] = (deadline, device, plugin)
+            heapq.heappush(self._deadlines, (deadline, device.device_id))
+            self._wakeup.notify()
+
+    def changed(self, device: IOTAbstractDevice, changes, plugin=None):
+        self.manager.on_device_changed(device, changes, plugin)
+        self.publish("changed", device.device_id, plugin, changes)
+
+    def is_pending_lost(self, device_id):
+        return device_id in self._lost
+
+    def _confirm_lost(self, device, plugin):
+        self.manager.on_device_lost(device, plugin)
+        self.publish("lost", device.device_id, plugin)
+
+    def _expired(self, now):
+        """ (deadline, device_id) of the losses whose grace period ended"""
+        expired = []
+        with self._wakeup:
+            while self._deadlines and self._deadlines[0][0] <= now:
+                expired.append(heapq.heappop(self._deadlines))
+        return expired
+
+    def _confirm_expired(self, deadline, device_id):
+        """ confirm a loss unless the device was found, or lost again later,
+        since its deadline was popped"""
+        with self._presence:
+            with self._wakeup:
+                pending = self._lost.get(device_id)
+                if pending is None or pending[0] != deadline:
+                    return
+                del self._lost[device_id]
+                self._flaps.pop(device_id, None)
+            self._confirm_lost(*pending[1:])
+
+    def _next_wakeup(self):
+        times = [s.due() for s in self.subscribers]
+        if self._deadlines:
+            times.append(self._deadlines[0][0])
+        times = [t for t in times if t is not None]
+        return min(times) if times else None
+
+    def process(self, now=None, force=False):
+        """ confirm expired losses and deliver the due batches,
+        force delivers every pending batch right away"""
+        now = now or time.monotonic()
+        for deadline, device_id in self._expired(now):
+            self._confirm_expired(deadline, device_id)
+        with self._wakeup:
+            batches = [(subscriber, subscriber.take(now)) for subscriber in self.subscribers
+                       if subscriber.pending and (force or subscriber.due() <= now)]
+        for subscriber, events in batches:
+            EVENT_BATCHES.inc(subscriber=subscriber.name)
+            try:
+                subscriber.callback(events)
+            except Exception as e:
+                LOG.exception(f"device event subscriber {subscriber.name} failed: {e}")
+
+    def run(self):
+        while not self._stopped.is_set():
+            with self._wakeup:
+                wakeup = self._next_wakeup()
+                timeout = None if wakeup is None else max(0.0, wakeup - time.monotonic())
+                self._wakeup.wait(timeout)
+            if self._stopped.is_set():
+                break
+            try:
+                self.process()
+            except Exception as e:
+                LOG.exception(f"device event pipeline failed: {e}")
+
+    def stop(self):
+        """ deliver pending batches, losses still in their grace period are dropped"""
+        self._stopped.set()
+        with self._wakeup:
+            self._wakeup.notify()
+        self.process(force=True)
@@ -0,0 +1,211 @@
+import re
+from threading import RLock
+
+from ovos_PHAL_plugin_commonIOT.opm.base import IOTAbstractDevice, IOTDeviceType
+
+STOPWORDS = {"the", "a", "an", "my", "our", "in", "on", "of", "at", "all", "please"}
+
+# words users say for a device type, "the kitchen lights"
+TYPE_WORDS = {
+    IOTDeviceType.BULB: ("light", "lamp", "bulb"),
+    IOTDeviceType.RGB_BULB: ("light", "lamp", "bulb"),
+    IOTDeviceType.RGBW_BULB: ("light", "lamp", "bulb"),
+    IOTDeviceType.PLUG: ("plug", "socket", "outlet"),
+    IOTDeviceType.SWITCH: ("switch",),
+    IOTDeviceType.TV: ("tv", "television"),
+    IOTDeviceType.RADIO: ("radio",),
+    IOTDeviceType.HEATER: ("heater", "heating"),
+    IOTDeviceType.AC: ("ac", "air conditioner", "air conditioning"),
+    IOTDeviceType.VENT: ("vent", "fan"),
+    IOTDeviceType.HUMIDIFIER: ("humidifier",),
+    IOTDeviceType.CAMERA: ("camera",),
+    IOTDeviceType.MEDIA_PLAYER: ("player", "speaker"),
+    IOTDeviceType.VACUUM: ("vacuum", "robot"),
+    IOTDeviceType.SENSOR: ("sensor",)
+}
+
+# how much a matched token counts, by the field it came from
+FIELD_WEIGHTS = {"name": 1.0, "alias": 1.0, "area": 0.8, "type": 0.6}
+
+
+def normalize(text):
+    """ lower case tokens without stopwords, plurals are reduced"""
+    tokens = []
+    for token in re.split(r"[^a-z0-9]+", str(text).lower()):
+        if not token or token in STOPWORDS:
+            continue
+        if len(token) > 3 and token.endswith("s") and not token.endswith("ss"):
+            token = token[:-1]
+        tokens.append(token)
+    return tokens
+
+
+def trigrams(token):
+    padded = f"  {token} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class DeviceNameIndex:
+    """ resolves spoken device references to device_ids
+
+    device names, scanner aliases, areas and device type words are split in
+    tokens, an inverted index maps every token to the devices using it and a
+    trigram index over the token vocabulary finds misheard or misspelled
+    words, devices are added and removed incrementally"""
+
+    def __init__(self, min_similarity=0.5):
+        self.min_similarity = min_similarity
+        self._postings = {}  # token -> {device_id: weight}
+        self._trigrams = {}  # trigram -> set of tokens
+        self._device_tokens = {}  # device_id -> {token: weight}
+        self._indexed = {}  # device_id -> (name, area, device_type) it was indexed with
+        self._fuzzy_cache = {}  # query token -> [(token, similarity)]
+        self._results = {}  # normalized query -> ranked matches, cleared on changes
+        self.cache_size = 256
+        self._lock = RLock()
+
+    @staticmethod
+    def phrases(device: IOTAbstractDevice, aliases=None):
+        """ (field, text) pairs a device can be called by"""
+        phrases = [("name", device.name)]
+        if isinstance(aliases, str):
+            aliases = [aliases]
+        phrases += [("alias", alias) for alias in aliases or ()]
+        if isinstance(device.device_area, str):
+            phrases.append(("area", device.device_area))
+        phrases += [("type", word) for word in TYPE_WORDS.get(device.device_type, ())]
+        return phrases
+
+    def add(self, device: IOTAbstractDevice, aliases=None):
+        """ index a device, replaces its previous entry"""
+        tokens = {}
+        for field, text in self.phrases(device, aliases):
+            for token in normalize(text):
+                tokens[token] = max(tokens.get(token, 0), FIELD_WEIGHTS[field])
+        with self._lock:
+            self.remove(device.device_id)
+            self._results.clear()
+            for token, weight in tokens.items():
+                if token not in self._postings:
+                    self._postings[token] = {}
+                    for gram in trigrams(token):
+                        self._trigrams.setdefault(gram, set()).add(token)
+                    self._fuzzy_cache.clear()
+                self._postings[token][device.device_id] = weight
+            self._device_tokens[device.device_id] = tokens
+            self._indexed[device.device_id] = self._indexed_fields(device)
+
+    @staticmethod
+    def _indexed_fields(device):
+        area = device.device_area
+        return device.name, area if isinstance(area, str) else None, device.device_type
+
+    def is_current(self, device: IOTAbstractDevice):
+        """ False if the name, area or type of a device changed since it was indexed"""
+        return self._indexed.get(device.device_id) == self._indexed_fields(device)
+
+    def remove(self, device_id):
+        with self._lock:
+            if device_id in self._device_tokens:
+                self._results.clear()
+            self._indexed.pop(device_id, None)
+            for token in self._device_tokens.pop(device_id, ()):
+                devices = self._postings.get(token)
+                if devices is None:
+                    continue
+                devices.pop(device_id, None)
+                if not devices:
+                    del self._postings[token]
+                    for gram in trigrams(token):
+                        tokens = self._trigrams.get(gram)
+                        if tokens is not None:
+                            tokens.discard(token)
+                            if not tokens:
+                                del self._trigrams[gram]
+                    self._fuzzy_cache.clear()
+
+    def _matches(self, token):
+        """ [(indexed token, similarity)] for a query token"""
+        if token in self._postings:
+            return [(token, 1.0)]
+        cached = self._fuzzy_cache.get(token)
+        if cached is not None:
+            return cached
+        grams = trigrams(token)
+        shared = {}
+        for gram in grams:
+            for candidate in self._trigrams.get(gram, ()):
+                shared[candidate] = shared.get(candidate, 0) + 1
+        matches = []
+        for candidate, n in shared.items():
+            # dice coefficient over the trigram sets
+            similarity = 2 * n / (len(grams) + len(trigrams(candidate)))
+            if similarity >= self.min_similarity:
+                matches.append((candidate, similarity))
+        self._fuzzy_cache[token] = matches
+        return matches
+
+    def resolve(self, utterance, limit=5):
+        """ [(device_id, score)] best matches first, score is 0-1
+
+        every query token adds the best weighted similarity it has with a
+        device, devices matching more of their own tokens rank higher
+
+        tokens are scored rarest first, a token matching more devices than
+        the candidates found so far (eg. "light") only ranks those candidates"""
+        query = tuple(dict.fromkeys(normalize(utterance)))
+        if not query:
+            return []
+        with self._lock:
+            ranked = self._results.get(query)
+            if ranked is None:
+                ranked = self._rank(query)
+                if len(self._results) >= self.cache_size:
+                    self._results.pop(next(iter(self._results)))
+                self._results[query] = ranked
+        return ranked[:limit] if limit else list(ranked)
+
+    def _rank(self, query):
+        scores = {}  # device_id -> [score, exact token matches]
+        matched = []
+        for token in query:
+            matches = self._matches(token)
+            size = sum(len(self._postings[match]) for match, _ in matches)
+            matched.append((size, matches))
+        matched.sort(key=lambda m: m[0])
+        for size, matches in matched:
+            refine = scores and size > len(scores)
+            best = {}  # device_id -> best score of this token
+            exact = set()
+            for match, similarity in matches:
+                postings = self._postings[match]
+                if refine:
+                    # broad token, only ranks the devices found so far
+                    pairs = ((device_id, postings[device_id])
+                             for device_id in scores if device_id in postings)
+                else:
+                    pairs = postings.items()
+                for device_id, weight in pairs:
+                    score = similarity * weight
+                    if score > best.get(device_id, 0):
+                        best[device_id] = score
+                        if similarity == 1.0:
+                            exact.add(device_id)
+            for device_id, score in best.items():
+                entry = scores.get(device_id)
+                if entry is None:
+                    scores[device_id] = [score, device_id in exact]
+                else:
+                    entry[0] += score
+                    entry[1] += device_id in exact
+        n = len(query)
+        ranked = [(device_id, score / n * 0.9 + exact / len(self._device_tokens[device_id]) * 0.1)
+                  for device_id, (score, exact) in scores.items()]
+        ranked.sort(key=lambda m: (-m[1], m[0]))
+        return ranked
+
+    def __contains__(self, device_id):
+        return device_id in self._device_tokens
+
+    def __len__(self):
+        return len(self._device_tokens)
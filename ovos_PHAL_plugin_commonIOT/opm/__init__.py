@@ -1,5 +1,6 @@
 from ovos_plugin_manager.utils import load_plugin, find_plugins
 import enum
+from importlib.metadata import entry_points
 
 
 class PluginTypes(str, enum.Enum):
@@ -11,6 +12,18 @@ def find_iot_plugins():
     return find_plugins(PluginTypes.IOT)
 
 
+def find_iot_entry_points():
+    """ name -> EntryPoint of every installed iot plugin, nothing is imported
+
+    call EntryPoint.load() to import the IOTScannerPlugin class"""
+    eps = entry_points()
+    if hasattr(eps, "select"):
+        eps = eps.select(group=PluginTypes.IOT.value)
+    else:  # python < 3.10 returns a dict of group -> entry points
+        eps = eps.get(PluginTypes.IOT.value, [])
+    return {ep.name: ep for ep in eps}
+
+
 def load_iot_plugin(module_name):
     """Wrapper function for loading iot plugin.
     Arguments:
@@ -0,0 +1,119 @@
+""" async device API
+
+device classes list their commands in async_methods, a plugin implements
+either turn_on or async_turn_on and the other side is generated when the
+class is created: async shims run the blocking method in the device loop
+executor, sync shims run the coroutine on the shared DeviceLoop and wait"""
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from threading import Thread, Lock
+
+
+class DeviceLoop(Thread):
+    """ asyncio event loop shared by every async device, in its own thread
+
+    blocking device methods awaited through async shims run in a bounded
+    thread pool set as the loop default executor"""
+
+    def __init__(self, max_workers=16):
+        super().__init__(daemon=True, name="iot-device-loop")
+        self.executor = ThreadPoolExecutor(max_workers=max_workers,
+                                           thread_name_prefix="iot-device")
+        self.loop = asyncio.new_event_loop()
+        self.loop.set_default_executor(self.executor)
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def in_loop(self):
+        """ True when called from a coroutine or callback of this loop"""
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    def submit(self, coro):
+        """ schedule a coroutine, returns a concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run_sync(self, coro, timeout=None):
+        """ run a coroutine from a blocking caller, cancelled on timeout"""
+        future = self.submit(coro)
+        try:
+            return future.result(timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            raise
+
+
+_LOOP = None
+_LOOP_LOCK = Lock()
+
+
+def get_device_loop():
+    """ the shared DeviceLoop, started on first use"""
+    global _LOOP
+    with _LOOP_LOCK:
+        if _LOOP is None:
+            _LOOP = DeviceLoop()
+            _LOOP.start()
+    return _LOOP
+
+
+def async_shim(name):
+    """ async_<name> awaiting the blocking <name> in an executor thread"""
+
+    async def shim(self, *args, **kwargs):
+        method = functools.partial(getattr(self, name), *args, **kwargs)
+        return await asyncio.get_running_loop().run_in_executor(None, method)
+
+    shim.__name__ = shim.__qualname__ = f"async_{name}"
+    shim.async_shim = shim.state_cached = True
+    return shim
+
+
+def sync_shim(name):
+    """ blocking <name> running async_<name> on the device loop"""
+
+    def shim(self, *args, **kwargs):
+        loop = get_device_loop()
+        if loop.in_loop():
+            raise RuntimeError(f"{name} would block the device loop, await async_{name}")
+        return loop.run_sync(getattr(self, f"async_{name}")(*args, **kwargs))
+
+    shim.__name__ = shim.__qualname__ = name
+    shim.async_shim = shim.state_cached = True
+    return shim
+
+
+def native_side(cls, name):
+    """ "sync", "async" or "both" for the nearest class in the MRO
+    implementing name or async_name itself, None if nobody does"""
+    for klass in cls.__mro__:
+        sync = klass.__dict__.get(name)
+        coro = klass.__dict__.get(f"async_{name}")
+        sync = sync is not None and not getattr(sync, "async_shim", False)
+        coro = coro is not None and not getattr(coro, "async_shim", False)
+        if sync and coro:
+            return "both"
+        if sync:
+            return "sync"
+        if coro:
+            return "async"
+    return None
+
+
+def install_async_api(cls):
+    """ generate the missing side of every method in cls.async_methods,
+    returns the names implemented natively as coroutines"""
+    native_async = set()
+    for name in cls.async_methods:
+        side = native_side(cls, name)
+        if side == "sync":
+            setattr(cls, f"async_{name}", async_shim(name))
+        elif side == "async":
+            setattr(cls, name, sync_shim(name))
+            native_async.add(name)
+    return frozenset(native_async)
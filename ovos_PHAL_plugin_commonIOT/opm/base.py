@@ -1,13 +1,27 @@
+import asyncio
 import enum
+import functools
+import heapq
+import inspect
 import time
-from threading import Thread
-from time import sleep
+from threading import Thread, RLock, Event
 
 from ovos_config import Configuration
 from ovos_utils import camel_case_split
 from ovos_utils.log import LOG
 from ovos_utils.messagebus import get_mycroft_bus
 
+from ovos_PHAL_plugin_commonIOT.opm.aio import install_async_api
+from ovos_PHAL_plugin_commonIOT.opm.metrics import METRICS
+
+SCAN_SECONDS = METRICS.histogram("scan_seconds", "duration of scan cycles", ("plugin",))
+SCAN_DEVICES = METRICS.gauge("scan_devices", "devices returned by the last scan", ("plugin",))
+SCAN_ERRORS = METRICS.counter("scan_errors", "failed scan cycles", ("plugin",))
+DEVICE_EVENTS = METRICS.meter("device_events", "device presence and state events",
+                              ("plugin", "event"))
+STATE_READS = METRICS.counter("state_reads", "device state reads, from the state cache or the device",
+                              ("source",))
+
 
 class IOTDeviceType(str, enum.Enum):
     """ recognized device types handled by commonIOT"""
@@ -47,13 +61,139 @@ class IOTCapabilties(enum.Enum):
     PREV_PLAYBACK = enum.auto()
 
 
+# bitmask form of IOTCapabilties, computed once per device class
+IOTCapabilityFlag = enum.Flag("IOTCapabilityFlag", [c.name for c in IOTCapabilties])
+
+
+def capability_flag(capability):
+    """ IOTCapabilityFlag for an IOTCapabilties member, a flag or a name"""
+    if isinstance(capability, IOTCapabilityFlag):
+        return capability
+    if isinstance(capability, IOTCapabilties):
+        return IOTCapabilityFlag[capability.name]
+    return IOTCapabilityFlag[str(capability).upper()]
+
+
+def capability_mask(capabilities):
+    """ a single IOTCapabilityFlag with every capability in a list set"""
+    mask = IOTCapabilityFlag(0)
+    for capability in capabilities:
+        try:
+            mask |= capability_flag(capability)
+        except (KeyError, ValueError):
+            LOG.warning(f"unknown capability: {capability}")
+    return mask
+
+
+def capability_names(mask):
+    """ names of the capabilities set in a mask, in declaration order"""
+    return tuple(flag.name for flag in IOTCapabilityFlag if flag & mask)
+
+
+def json_ready(value):
+    """ convert a device value into something that can be sent on the bus"""
+    if isinstance(value, enum.Enum):
+        return value.value if isinstance(value, str) else value.name
+    if isinstance(value, dict):
+        return {str(k): json_ready(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return [json_ready(v) for v in value]
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    return str(value)
+
+
+def _state_reader(name, prop):
+    """ property reading through the per device state cache"""
+
+    @functools.wraps(prop.fget)
+    def fget(self):
+        now = time.monotonic()
+        cached = self._state.get(name) if self._state else None
+        if cached is not None and cached[1] > now:
+            STATE_READS.inc(source="cache")
+            return cached[0]
+        STATE_READS.inc(source="device")
+        value = prop.fget(self)
+        self.cache_state({name: value}, now)
+        return value
+
+    fget.state_cached = True
+    return property(fget, prop.fset, prop.fdel, prop.__doc__)
+
+
+def _cache_written(device, written, args, kwargs):
+    """ cache the state a successful command set, never raises, when it
+    can not be worked out from the arguments the cached state is dropped"""
+    try:
+        device.cache_state(written(*args, **kwargs))
+    except Exception as e:
+        LOG.debug(f"{device.device_id}: can not cache the state set by a command: {e!r}")
+        device.invalidate_state()
+    device._snapshot = None
+
+
+def _state_writer(method, written):
+    """ command method updating the state cache with the values it set"""
+
+    @functools.wraps(method)
+    def command(self, *args, **kwargs):
+        try:
+            result = method(self, *args, **kwargs)
+        except Exception:
+            self.invalidate_state()  # the device may be anywhere now
+            raise
+        _cache_written(self, written, args, kwargs)
+        return result
+
+    command.state_cached = True
+    return command
+
+
+def _async_state_writer(method, written):
+    """ coroutine command updating the state cache with the values it set"""
+
+    @functools.wraps(method)
+    async def command(self, *args, **kwargs):
+        try:
+            result = await method(self, *args, **kwargs)
+        except (Exception, asyncio.CancelledError):
+            self.invalidate_state()
+            raise
+        _cache_written(self, written, args, kwargs)
+        return result
+
+    command.state_cached = True
+    return command
+
+
 class IOTScannerPlugin(Thread):
-    """ this class is loaded by CommonIOT and yields IOTDevices"""
+    """ this class is loaded by CommonIOT and yields IOTDevices
+
+    poll mode (default): subclasses implement scan(), called every
+    time_between_checks seconds
+
+    push mode: subclasses set push_mode = True, implement listen() to
+    subscribe to their protocol (mDNS, SSDP, BLE advertisements, MQTT...)
+    and report presence changes with device_seen / device_gone,
+    scan() is never called on a timer
+
+    scan interval is adaptive, it drops to min_interval after a device is
+    found or lost and grows by backoff_factor (error_backoff_factor if
+    scan() raised) up to max_interval while the network is stable
+
+    every sighting is compared against the previous one, so state the
+    device reports through properties (eg. is_on) raises change events,
+    live_changes = False (or the "live_changes" config key) only compares
+    devices whose reported fields changed, cheaper for large fleets"""
+    push_mode = False
+    live_changes = True
 
     def __init__(self, bus=None, name="", config=None,
                  new_device_callback=None,
                  lost_device_callback=None,
-                 aliases=None):
+                 aliases=None,
+                 changed_device_callback=None):
         super().__init__(daemon=True)
         self.config_core = Configuration()
         name = name or camel_case_split(self.__class__.__name__).replace(" ", "-").lower()
@@ -63,43 +203,358 @@ class IOTScannerPlugin(Thread):
         self.name = name
         self.new_device_callback = new_device_callback
         self.lost_device_callback = lost_device_callback
-        self.timestamps = {}
+        self.changed_device_callback = changed_device_callback
+        self.timestamps = {}  # device_id -> last seen device object
         self.aliases = aliases or {}
-        self.ttl = 30  # if not seen for 30 seconds, consider device lost
-        self.time_between_checks = 3  # seconds between scans
+        # expiry is tracked on a monotonic clock so wall clock jumps (NTP)
+        # can not expire every device at once
+        self._last_seen = {}  # device_id -> monotonic timestamp
+        self._deadlines = {}  # device_id -> expiry deadline queued in the heap
+        self._expiry = []  # min-heap of (deadline, device_id)
+        self._fingerprints = {}  # device_id -> (field names, field hashes)
+        self._field_names = {}  # interned field name tuples, shared by devices
+        self._tentative = set()  # device_ids restored from cache, not seen yet
+        self.push_mode = self.config.get("push_mode", self.push_mode)
+        self.last_error = None
+        self.consecutive_failures = 0  # failed scans in a row
+        self.last_scan = None  # monotonic time the last scan cycle finished
+        self.scan_started = None  # monotonic time the running scan started, if any
+        self._changed = False
+        self._lock = RLock()
+        self._stopped = Event()
+        self._load_timing_config()
+
+    def _load_timing_config(self):
+        # values a plugin set in code are its defaults, config keys override them
+        defaults = self.__dict__.get("_timing_defaults", {})
+        get = lambda key, default: self.config.get(key, defaults.get(key, default))
+        self.min_interval = get("min_interval", 3)
+        self.max_interval = max(get("max_interval", 60), self.min_interval)
+        self.backoff_factor = get("backoff_factor", 1.5)
+        self.error_backoff_factor = get("error_backoff_factor", 2)
+        # if not seen for ttl seconds, consider device lost
+        self.min_ttl = get("ttl", 30)
+        # number of scans a device may be missing from before it's lost
+        self.ttl_scans = get("ttl_scans", 3)
+        if "interval" in self.config:  # fixed interval, disables adaptive scans
+            self.min_interval = self.max_interval = self.config["interval"]
+        self._interval = self.min_interval  # seconds until the next scan
+
+    def _set_timing_default(self, key, value):
+        self.__dict__.setdefault("_timing_defaults", {})[key] = value
+        if "config" in self.__dict__:
+            self._load_timing_config()
+
+    def update_config(self, config):
+        """ merge per-plugin config and reload scan timing """
+        self.config = {**self.config, **config}
+        self._load_timing_config()
+
+    @property
+    def time_between_checks(self):
+        return self._interval
+
+    @time_between_checks.setter
+    def time_between_checks(self, value):
+        # legacy plugins set a fixed interval in __init__, it becomes their min_interval
+        self._set_timing_default("min_interval", value)
+
+    @property
+    def ttl(self):
+        if self.push_mode:
+            return self.min_ttl
+        # a backed off scanner must not expire devices between scans
+        return max(self.min_ttl, self.ttl_scans * self._interval)
+
+    @ttl.setter
+    def ttl(self, value):
+        self._set_timing_default("ttl", value)
+
+    def adapt_interval(self, changed=False, failed=False):
+        """ pick the delay until the next scan cycle """
+        if failed:
+            factor = self.error_backoff_factor
+        elif changed:
+            self._interval = self.min_interval
+            return self._interval
+        else:
+            factor = self.backoff_factor
+        self._interval = min(self._interval * factor, self.max_interval)
+        return self._interval
 
     def run(self):
-        while True:
-            for dev in self.scan():
-                dev._raw["last_seen"] = time.time()
-                if dev.device_id not in self.timestamps:
-                    print(f"found device: {dev.device_id}")
-                    if self.new_device_callback:
-                        self.new_device_callback(dev)
-                self.timestamps[dev.device_id] = dev  # update last seen
-
-            for device_id, dev in dict(self.timestamps).items():
-                if time.time() - dev.raw_data.get("last_seen", 0) > self.ttl:
-                    # based on last_seen timestamp
-                    print(f"lost device: {device_id}")
-                    self.timestamps.pop(device_id)
-                    if self.lost_device_callback:
-                        self.lost_device_callback(dev)
-
-            sleep(self.time_between_checks)
+        if self.push_mode:
+            self.listen()
+        while not self._stopped.is_set():
+            self.scan_once()
+            self._stopped.wait(self.time_between_checks)
+
+    def stop(self):
+        """ end run() after the current scan cycle"""
+        self._stopped.set()
+
+    def scan_once(self):
+        """ run a single discovery cycle, used by run() and by ScanScheduler"""
+        if not self.push_mode:
+            start = self.scan_started = time.monotonic()
+            n_devices = 0
+            try:
+                for dev in self.scan():
+                    self.device_seen(dev)
+                    n_devices += 1
+            except Exception as e:
+                # devices were not refreshed, do not expire them
+                self.log.error(f"{self.name} scan failed: {e}")
+                SCAN_ERRORS.inc(plugin=self.name)
+                self.last_error = e
+                self.consecutive_failures += 1
+                self.last_scan = time.monotonic()
+                self.adapt_interval(failed=True)
+                return
+            finally:
+                self.scan_started = None
+                SCAN_SECONDS.observe(time.monotonic() - start, plugin=self.name)
+            SCAN_DEVICES.set(n_devices, plugin=self.name)
+            self.consecutive_failures = 0
+        self.expire_devices()
+        self.last_scan = time.monotonic()
+        changed, self._changed = self._changed, False
+        self.adapt_interval(changed=changed)
+
+    def device_seen(self, dev):
+        """ report a device as present, refreshes its last seen timestamp
+
+        push mode scanners call this whenever their protocol announces a device
+
+        without live_changes a known device is only checked for changes
+        when update() changed one of its reported fields, sightings of an
+        unchanged device allocate nothing besides the timestamps"""
+        now = time.monotonic()
+        with self._lock:
+            known = self.timestamps.get(dev.device_id)
+            # a device restored from cache is announced on its first sighting
+            is_new = known is None or dev.device_id in self._tentative
+            self._tentative.discard(dev.device_id)
+            if is_new and known is not None:
+                # the plugin's own object replaces the one restored from cache
+                known = None
+                self._fingerprints.pop(dev.device_id, None)
+            if known is not None and known is not dev and type(known) is type(dev):
+                # keep a single object per device, update it in place
+                known.update_from(dev)
+                dev = known
+            self.timestamps[dev.device_id] = dev  # update last seen
+            self._last_seen[dev.device_id] = now
+            dev.last_seen = time.time()
+            if dev._raw is not None:
+                dev._raw["last_seen"] = dev.last_seen
+            if dev.device_id not in self._deadlines:
+                self._schedule_expiry(dev.device_id, now + self.ttl)
+            old_fingerprint = self._fingerprints.get(dev.device_id)
+            if not is_new and not dev._dirty and old_fingerprint is not None \
+                    and not self.config.get("live_changes", self.live_changes):
+                return
+            dev._dirty = False
+        state = self.device_state(dev)
+        fields = tuple(state)
+        fields = self._field_names.setdefault(fields, fields)
+        fingerprint = (fields, tuple(hash(repr(v)) for v in state.values()))
+        with self._lock:
+            self._fingerprints[dev.device_id] = fingerprint
+        if is_new:
+            self._changed = True
+            self.log.info(f"found device: {dev.device_id}")
+            DEVICE_EVENTS.inc(plugin=self.name, event="new")
+            if self.new_device_callback:
+                self.new_device_callback(dev)
+        elif old_fingerprint is not None and fingerprint != old_fingerprint:
+            old_hashes = dict(zip(*old_fingerprint))
+            changes = {k: v for k, h, v in zip(fields, fingerprint[1], state.values())
+                       if old_hashes.get(k) != h}
+            changes.update({k: None for k in old_hashes if k not in state})
+            dev.invalidate_snapshot()
+            self._changed = True
+            self.log.debug(f"changed device: {dev.device_id} {list(changes)}")
+            DEVICE_EVENTS.inc(plugin=self.name, event="changed")
+            if self.changed_device_callback:
+                self.changed_device_callback(dev, changes)
+
+    def adopt(self, dev, tentative=True):
+        """ track a device known from elsewhere, eg. restored from cache
+
+        a tentative device is announced by its next sighting, otherwise it
+        is tracked as already known, both are lost after the normal ttl"""
+        now = time.monotonic()
+        with self._lock:
+            if dev.device_id in self.timestamps:
+                return
+            if tentative:
+                self._tentative.add(dev.device_id)
+            self.timestamps[dev.device_id] = dev
+            self._last_seen[dev.device_id] = now
+            self._schedule_expiry(dev.device_id, now + self.ttl)
+
+    def is_tentative(self, device_id):
+        return device_id in self._tentative
+
+    @staticmethod
+    def device_state(dev):
+        """ flat view of everything a device reports, used for change detection
+
+        as_dict fields keep their names, raw_data fields are prefixed by 'raw.',
+        the fields the manager indexes are always included, whatever as_dict
+        a device class defines"""
+        state = {k: v for k, v in dev.as_dict.items() if k != "raw"}
+        state.update(host=dev.host, name=dev.name, area=dev.device_area,
+                     device_type=dev.device_type, device_class=type(dev).__name__)
+        # a raw_data derived from the device fields adds nothing to compare
+        state.update({f"raw.{k}": v for k, v in (dev._raw or {}).items()
+                      if k != "last_seen"})
+        return state
+
+    def device_gone(self, dev):
+        """ report a device as lost without waiting for the ttl to expire
+
+        push mode scanners call this when their protocol announces a departure"""
+        device_id = dev if isinstance(dev, str) else dev.device_id
+        with self._lock:
+            dev = self.timestamps.pop(device_id, None)
+            self._last_seen.pop(device_id, None)
+            # leaves a stale heap entry behind, skipped when popped
+            self._deadlines.pop(device_id, None)
+            self._fingerprints.pop(device_id, None)
+            self._tentative.discard(device_id)
+        if dev is not None:
+            self._changed = True
+            self.log.info(f"lost device: {device_id}")
+            DEVICE_EVENTS.inc(plugin=self.name, event="lost")
+            if self.lost_device_callback:
+                self.lost_device_callback(dev)
+
+    def _schedule_expiry(self, device_id, deadline):
+        self._deadlines[device_id] = deadline
+        heapq.heappush(self._expiry, (deadline, device_id))
+
+    def expire_devices(self):
+        """ report devices not seen for longer than the ttl as lost
+
+        only devices whose deadline is due are visited, a device seen since
+        its deadline was queued is pushed back with last_seen + ttl"""
+        now = time.monotonic()
+        ttl = self.ttl
+        expired = []
+        with self._lock:
+            while self._expiry and self._expiry[0][0] <= now:
+                deadline, device_id = heapq.heappop(self._expiry)
+                if self._deadlines.get(device_id) != deadline:
+                    continue  # stale entry, device already lost
+                deadline = self._last_seen[device_id] + ttl
+                if deadline > now:
+                    self._schedule_expiry(device_id, deadline)
+                else:
+                    expired.append(device_id)
+        for device_id in expired:
+            self.device_gone(device_id)
+
+    def listen(self):
+        """ push mode only, start listening for presence announcements
+
+        must not block, the base class keeps running ttl expiry afterwards"""
+        raise NotImplementedError("listen method must be implemented by push mode scanners")
 
     def scan(self):
         raise NotImplemented("scan method must be implemented by subclasses")
 
+    def intern_device(self, device_cls, device_id, host=None, name=None,
+                      area=None, raw_data=None, **kwargs):
+        """ get a device object for use in scan()
+
+        returns the already tracked object for device_id updated in place,
+        a new device_cls object is only created for unknown devices"""
+        with self._lock:
+            dev = self.timestamps.get(device_id)
+        if dev is None or type(dev) is not device_cls or kwargs:
+            fields = {k: v for k, v in (("host", host), ("name", name),
+                                        ("area", area), ("raw_data", raw_data))
+                      if v is not None}
+            return device_cls(device_id, **fields, **kwargs)
+        dev.update(host=host, name=name, area=area, raw_data=raw_data)
+        return dev
+
     def get_device(self, ip):
-        for device in self.scan():
+        if self.push_mode:
+            with self._lock:
+                devices = list(self.timestamps.values())
+        else:
+            devices = self.scan()
+        for device in devices:
             if device.host == ip:
                 return device
         return None
 
 
+@functools.lru_cache(maxsize=None)
+def _plugin_slots(cls):
+    """ slot names declared by the subclasses of IOTAbstractDevice"""
+    slots = []
+    for klass in cls.__mro__:
+        if klass is IOTAbstractDevice:
+            break
+        names = klass.__dict__.get("__slots__", ())
+        for name in [names] if isinstance(names, str) else names:
+            if name in ("__dict__", "__weakref__"):
+                continue
+            if name.startswith("__") and not name.endswith("__"):
+                name = f"_{klass.__name__.lstrip('_')}{name}"  # mangled
+            slots.append(name)
+    return tuple(slots)
+
+
 class IOTAbstractDevice:
-    capabilities = []
+    """ base class for all devices
+
+    device classes shipped here define __slots__, plugin subclasses that
+    also declare __slots__ avoid a per instance __dict__ entirely"""
+    __slots__ = ("_device_type", "_device_id", "_name", "_host", "_area",
+                 "_raw", "mode", "_snapshot", "last_seen", "_state", "_dirty")
+    capabilities = []  # IOTCapabilties, subclasses extend it
+    capability_mask = IOTCapabilityFlag(0)  # derived from capabilities
+    max_command_rate = None  # commands per second, None uses the global limit
+    # state property -> seconds a value read from the device is reused
+    state_ttl = {"is_on": 5}
+    # command method -> f(*args, **kwargs) returning the state it sets,
+    # called with the command arguments, it must accept extra ones
+    state_writes = {
+        "turn_on": lambda *args, **kwargs: {"is_on": True},
+        "turn_off": lambda *args, **kwargs: {"is_on": False}
+    }
+    # commands with a coroutine twin, async_turn_on... see opm.aio
+    async_methods = ("refresh_state",)
+    async_native = frozenset()  # async_methods implemented as coroutines
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.capability_mask = capability_mask(cls.capabilities)
+        # state properties and commands defined by this class go through
+        # the state cache, subclasses overriding them are wrapped again
+        for name in cls.state_ttl:
+            prop = cls.__dict__.get(name)
+            if isinstance(prop, property) and prop.fget is not None \
+                    and not getattr(prop.fget, "state_cached", False):
+                setattr(cls, name, _state_reader(name, prop))
+        for name, written in cls.state_writes.items():
+            method = cls.__dict__.get(name)
+            if callable(method) and not getattr(method, "state_cached", False):
+                setattr(cls, name, _state_writer(method, written))
+            method = cls.__dict__.get(f"async_{name}")
+            if inspect.iscoroutinefunction(method) and not getattr(method, "state_cached", False):
+                setattr(cls, f"async_{name}", _async_state_writer(method, written))
+        # plugins implement the sync or the async side, the other is generated
+        cls.async_native = install_async_api(cls)
+
+    def has_capability(self, capability):
+        """ constant time check, capability may be a member, flag or name"""
+        return bool(self.capability_mask & capability_flag(capability))
 
     def __init__(self, device_id, host=None, name="abstract_device",
                  area=None, device_type=IOTDeviceType.SENSOR, raw_data=None):
@@ -109,11 +564,56 @@ class IOTAbstractDevice:
         self._name = name or self.__class__.__name__
         self._host = host
         self._area = area
-        self._raw = raw_data or {
-            "name": name, "host": host,
-            "area": area, "device_id": device_id}
-        self.mode = ""
-        self._timer = None
+        self._raw = raw_data or None  # only stored if the plugin reported it
+        self.mode = ""  # name of the running effect, if any
+        self._snapshot = None
+        self.last_seen = None  # wall clock time of the last sighting
+        self._state = None  # state property -> (value, monotonic expiry)
+        self._dirty = True  # reported fields changed since the last fingerprint
+
+    def update(self, host=None, name=None, area=None, raw_data=None,
+               device_type=None):
+        """ update reported fields in place, None values are left unchanged
+
+        returns True if anything changed"""
+        changed = False
+        for attr, value in (("_host", host), ("_name", name), ("_area", area),
+                            ("_raw", raw_data), ("_device_type", device_type)):
+            if value is None:
+                continue
+            current = getattr(self, attr)
+            if attr == "_raw" and current and "last_seen" in current and "last_seen" not in value:
+                # set by the scanner, not part of what the plugin reports
+                value = {**value, "last_seen": current["last_seen"]}
+            if value != current:
+                setattr(self, attr, value)
+                changed = True
+        if changed:
+            self._snapshot = None
+            self._state = None  # a fresh report beats cached reads
+            self._dirty = True
+        return changed
+
+    def update_from(self, other):
+        """ copy reported fields from a newer sighting of the same device"""
+        changed = self.update(host=other._host, name=other._name, area=other._area,
+                              raw_data=other._raw, device_type=other._device_type)
+        # plugin subclasses keep extra state in their own __slots__
+        for slot in _plugin_slots(type(other)):
+            if not hasattr(other, slot):
+                continue
+            value = getattr(other, slot)
+            if not hasattr(self, slot) or getattr(self, slot) is not value:
+                setattr(self, slot, value)
+                self._snapshot = self._state = None
+                self._dirty = changed = True
+        # or in __dict__ when they do not declare __slots__
+        if hasattr(other, "__dict__") and hasattr(self, "__dict__") \
+                and self.__dict__ != other.__dict__:
+            self.__dict__.update(other.__dict__)
+            self._snapshot = None
+            self._dirty = changed = True
+        return changed
 
     @property
     def as_dict(self):
@@ -127,6 +627,47 @@ class IOTAbstractDevice:
             "state": self.is_on
         }
 
+    @property
+    def snapshot(self):
+        """ JSON ready as_dict, cached until the device state changes
+
+        reading it does not query the device, call invalidate_snapshot
+        after changing state"""
+        if self._snapshot is None:
+            self._snapshot = json_ready(self.as_dict)
+        return self._snapshot
+
+    def invalidate_snapshot(self):
+        self._snapshot = None
+
+    # state cache
+    def cache_state(self, values, now=None):
+        """ store state values, only properties listed in state_ttl are kept"""
+        now = now or time.monotonic()
+        for name, value in values.items():
+            ttl = self.state_ttl.get(name)
+            if not ttl:
+                continue
+            if self._state is None:
+                self._state = {}
+            self._state[name] = (value, now + ttl)
+
+    def invalidate_state(self, *names):
+        """ forget cached state values, all of them if no name is given"""
+        if not names or self._state is None:
+            self._state = None
+            return
+        for name in names:
+            self._state.pop(name, None)
+
+    def refresh_state(self, *names):
+        """ query the device for state values, all cached properties if no
+        name is given, returns {name: fresh value}"""
+        names = names or tuple(self.state_ttl)
+        self.invalidate_state(*names)
+        self._snapshot = None
+        return {name: getattr(self, name) for name in names if hasattr(type(self), name)}
+
     @property
     def device_id(self):
         return self._device_id or self.raw_data.get("device_id")
@@ -145,6 +686,12 @@ class IOTAbstractDevice:
 
     @property
     def raw_data(self):
+        if self._raw is None:
+            # only built when somebody asks, plugins may write to it
+            self._raw = {"name": self._name, "host": self._host,
+                         "area": self._area, "device_id": self._device_id}
+            if self.last_seen is not None:
+                self._raw["last_seen"] = self.last_seen
         return self._raw
 
     @property
@@ -174,6 +721,7 @@ class IOTAbstractDevice:
 
 
 class Sensor(IOTAbstractDevice):
+    __slots__ = ()
     capabilities = [
         IOTCapabilties.REPORT_STATUS
     ]
@@ -184,10 +732,12 @@ class Sensor(IOTAbstractDevice):
 
 
 class Switch(Sensor):
+    __slots__ = ()
     capabilities = Sensor.capabilities + [
         IOTCapabilties.TURN_ON,
         IOTCapabilties.TURN_OFF
     ]
+    async_methods = Sensor.async_methods + ("turn_on", "turn_off", "toggle", "reset")
 
     def __init__(self, device_id, host=None, name="generic_switch",
                  area=None, device_type=IOTDeviceType.SWITCH, raw_data=None):
@@ -195,7 +745,6 @@ class Switch(Sensor):
 
     def reset(self):
         self.mode = ""
-        self._timer = None
         self.turn_on()
 
     # status change
@@ -216,6 +765,8 @@ class Switch(Sensor):
 
 
 class Plug(Switch):
+    __slots__ = ()
+
     # Switch is binary, Plug maybe not
     # usually provides power consumption etc,
     def __init__(self, device_id, host=None, name="generic_plug",
@@ -0,0 +1,240 @@
+import asyncio
+import heapq
+import itertools
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from queue import Full
+from threading import Thread, Condition, Lock
+
+from ovos_utils.log import LOG
+
+from ovos_PHAL_plugin_commonIOT.opm.aio import get_device_loop
+from ovos_PHAL_plugin_commonIOT.opm.metrics import METRICS
+
+COMMAND_SECONDS = METRICS.histogram("command_seconds", "device command latency, excluding queueing",
+                                    ("device_class", "method"))
+COMMAND_WAIT_SECONDS = METRICS.histogram("command_wait_seconds", "time commands spend queued",
+                                         ("device_class", "method"))
+COMMAND_ERRORS = METRICS.counter("command_errors", "failed device commands",
+                                 ("device_class", "method"))
+COMMANDS_COALESCED = METRICS.counter("commands_coalesced", "commands superseded while pending",
+                                     ("device_class", "method"))
+
+# commands sharing a key supersede each other while pending,
+# only the latest one is sent
+COALESCE_KEYS = {
+    "turn_on": "power",
+    "turn_off": "power",
+    "change_brightness": "brightness",
+    "change_color": "color",
+    "change_color_rgb": "color",
+    "change_color_hex": "color",
+    "change_color_hsv": "color"
+}
+
+
+class DeviceCommandQueue:
+    """ pending commands of a single device, sent in order one at a time"""
+
+    def __init__(self, device, max_rate=None, max_pending=32):
+        self.device = device
+        self.max_rate = max_rate
+        self.max_pending = max_pending
+        self.pending = OrderedDict()  # key -> (method, args, kwargs, future, queued at)
+        self.next_send = 0  # monotonic time the next command may be sent
+        self.busy = False  # a command is in flight
+        self.scheduled = False  # queued in the dispatcher heap
+
+    @property
+    def min_interval(self):
+        return 1 / self.max_rate if self.max_rate else 0
+
+
+class CommandDispatcher(Thread):
+    """ sends device commands through per device queues
+
+    every device gets at most max_rate commands per second and one command
+    in flight, pending commands with the same coalesce key are replaced by
+    the newest one and submit() blocks while a device queue is full
+
+    devices implementing the async API get their commands awaited on the
+    shared DeviceLoop instead of occupying a worker thread, those are
+    cancelled after command_timeout seconds"""
+
+    def __init__(self, max_workers=8, max_rate=10, max_pending=32, command_timeout=None):
+        super().__init__(daemon=True)
+        self.max_rate = max_rate
+        self.max_pending = max_pending
+        self.command_timeout = command_timeout
+        self.executor = ThreadPoolExecutor(max_workers=max_workers,
+                                           thread_name_prefix="iot-commands")
+        self._queues = {}  # device -> DeviceCommandQueue
+        self._ready = []  # min-heap of (next_send, seq, DeviceCommandQueue)
+        self._idle = []  # min-heap of (next_send, seq, DeviceCommandQueue) emptied queues
+        self._seq = itertools.count()
+        self._cond = Condition()
+        self._running = False
+
+    def configure(self, max_rate=None, max_pending=None, command_timeout=None):
+        if max_rate is not None:
+            self.max_rate = max_rate
+        if max_pending is not None:
+            self.max_pending = max_pending
+        if command_timeout is not None:
+            self.command_timeout = command_timeout
+
+    def _prune(self, now):
+        """ forget queues left empty once their rate limit window passed,
+        lost and replaced devices would stay referenced forever otherwise"""
+        while self._idle and self._idle[0][0] <= now:
+            _, _, queue = heapq.heappop(self._idle)
+            if not queue.pending and not queue.busy and not queue.scheduled \
+                    and self._queues.get(queue.device) is queue:
+                del self._queues[queue.device]
+
+    def queue_of(self, device):
+        queue = self._queues.get(device)
+        if queue is None:
+            # devices may declare their own limit, eg. cheap wifi bulbs
+            max_rate = getattr(device, "max_command_rate", None) or self.max_rate
+            queue = self._queues[device] = DeviceCommandQueue(device, max_rate, self.max_pending)
+        return queue
+
+    @property
+    def pending_count(self):
+        return sum(len(q.pending) for q in list(self._queues.values()))
+
+    def submit(self, device, method, *args, coalesce=None, timeout=None, **kwargs):
+        """ queue device.method(*args, **kwargs), returns a Future
+
+        coalesce defaults to COALESCE_KEYS[method], None never coalesces,
+        raises queue.Full if the device queue stays full for timeout seconds"""
+        if coalesce is None:
+            coalesce = COALESCE_KEYS.get(method)
+        future = Future()
+        with self._cond:
+            self._prune(time.monotonic())
+            queue = self.queue_of(device)
+            key = coalesce if coalesce is not None else ("seq", next(self._seq))
+            if key not in queue.pending:
+                # backpressure, wait for the device to catch up
+                deadline = None if timeout is None else time.monotonic() + timeout
+                while len(queue.pending) >= queue.max_pending:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise Full(f"command queue full for {device}")
+                    self._cond.wait(remaining)
+            superseded = queue.pending.pop(key, None)
+            queue.pending[key] = (method, args, kwargs, future, time.monotonic())
+            self._schedule(queue)
+            start, self._running = not self._running, True
+        if superseded is not None:
+            COMMANDS_COALESCED.inc(device_class=type(device).__name__, method=superseded[0])
+            # callers waiting on the superseded command get the newer result
+            future.add_done_callback(lambda f, old=superseded[3]: _copy_result(f, old))
+        if start:
+            self.start()
+        return future
+
+    def _schedule(self, queue):
+        if queue.pending and not queue.busy and not queue.scheduled:
+            queue.scheduled = True
+            heapq.heappush(self._ready, (queue.next_send, next(self._seq), queue))
+            self._cond.notify_all()
+
+    def _send(self, queue, method, args, kwargs, future, queued):
+        labels = {"device_class": type(queue.device).__name__, "method": method}
+        start = time.monotonic()
+        COMMAND_WAIT_SECONDS.observe(start - queued, **labels)
+        try:
+            if future.set_running_or_notify_cancel():
+                future.set_result(getattr(queue.device, method)(*args, **kwargs))
+        except Exception as e:
+            LOG.error(f"{queue.device} {method} failed: {e}")
+            COMMAND_ERRORS.inc(**labels)
+            future.set_exception(e)
+        finally:
+            COMMAND_SECONDS.observe(time.monotonic() - start, **labels)
+            self._sent(queue)
+
+    async def _async_send(self, queue, method, args, kwargs, future, queued):
+        labels = {"device_class": type(queue.device).__name__, "method": method}
+        start = time.monotonic()
+        COMMAND_WAIT_SECONDS.observe(start - queued, **labels)
+        try:
+            if future.set_running_or_notify_cancel():
+                coro = getattr(queue.device, f"async_{method}")(*args, **kwargs)
+                future.set_result(await asyncio.wait_for(coro, self.command_timeout))
+        except asyncio.CancelledError:
+            future.set_exception(RuntimeError(f"{method} cancelled"))
+            raise
+        except Exception as e:
+            if isinstance(e, asyncio.TimeoutError):
+                e = TimeoutError(f"{method} timed out after {self.command_timeout}s")
+            LOG.error(f"{queue.device} {method} failed: {e}")
+            COMMAND_ERRORS.inc(**labels)
+            future.set_exception(e)
+        finally:
+            COMMAND_SECONDS.observe(time.monotonic() - start, **labels)
+            self._sent(queue)
+
+    def _sent(self, queue):
+        with self._cond:
+            queue.busy = False
+            queue.next_send = time.monotonic() + queue.min_interval
+            self._schedule(queue)
+            if not queue.pending:
+                heapq.heappush(self._idle, (queue.next_send, next(self._seq), queue))
+            self._cond.notify_all()
+
+    @staticmethod
+    def _is_async(device, method):
+        clazz = type(device)
+        return bool(getattr(clazz, "async_native", None)) and hasattr(clazz, f"async_{method}")
+
+    def run(self):
+        while True:
+            with self._cond:
+                while not self._ready:
+                    self._cond.wait()
+                now = time.monotonic()
+                next_send = self._ready[0][0]
+                if next_send > now:
+                    self._cond.wait(next_send - now)
+                    continue
+                _, _, queue = heapq.heappop(self._ready)
+                queue.scheduled = False
+                if not queue.pending:
+                    continue
+                _, command = queue.pending.popitem(last=False)
+                queue.busy = True
+                self._cond.notify_all()  # wake up blocked submitters
+            if self._is_async(queue.device, command[0]):
+                get_device_loop().submit(self._async_send(queue, *command))
+            else:
+                self.executor.submit(self._send, queue, *command)
+
+
+def _copy_result(source, target):
+    if target.done():
+        return
+    if source.cancelled():
+        target.cancel()
+    elif source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
+
+
+_DISPATCHER = None
+_DISPATCHER_LOCK = Lock()
+
+
+def get_command_dispatcher():
+    """ the shared CommandDispatcher, its thread starts with the first command"""
+    global _DISPATCHER
+    with _DISPATCHER_LOCK:
+        if _DISPATCHER is None:
+            _DISPATCHER = CommandDispatcher()
+    return _DISPATCHER
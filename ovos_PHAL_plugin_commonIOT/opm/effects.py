@@ -0,0 +1,263 @@
+import heapq
+import itertools
+import math
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from queue import Full
+from threading import Thread, Condition, Lock
+
+from ovos_utils.log import LOG
+
+from ovos_PHAL_plugin_commonIOT.opm.commands import get_command_dispatcher
+from ovos_PHAL_plugin_commonIOT.opm.palettes import fade_table, hsv_sweep_table, table_colors, wheel_table
+
+# frames are (command, value) tuples, applied with Bulb.apply_frame
+#   ("on", None), ("off", None), ("brightness", 0-100), ("color", (r, g, b))
+# effects are generators yielding (frame, delay until next frame),
+# frame may be None to only wait
+
+# frames queued for a bulb replace its pending command with the same key
+FRAME_COALESCE_KEYS = {"on": "power", "off": "power",
+                       "brightness": "brightness", "color": "color"}
+
+COLOR_WHEEL = (
+    (255, 0, 0),  # red
+    (255, 125, 0),  # orange
+    (255, 255, 0),  # yellow
+    (125, 255, 0),  # spring green
+    (0, 255, 0),  # green
+    (0, 255, 125),  # turquoise
+    (0, 255, 255),  # cyan
+    (0, 125, 255),  # ocean
+    (0, 0, 255),  # blue
+    (125, 0, 255),  # violet
+    (255, 0, 255),  # magenta
+    (255, 0, 125)  # raspberry
+)
+
+
+def beacon_slow_frames(speed=0.9):
+    while True:
+        for i in range(10, 105, 5):
+            yield ("brightness", i), 1 - speed
+        for i in range(95, 0, -5):
+            yield ("brightness", i), 1 - speed
+
+
+def beacon_frames(speed=0.7):
+    while True:
+        yield ("brightness", 100), 1 - speed
+        yield ("brightness", 50), 1 - speed
+        yield ("brightness", 1), 1 - speed
+        yield ("brightness", 50), 0
+
+
+def blink_frames(speed=0):
+    while True:
+        yield ("off", None), 1 - speed
+        yield ("on", None), 1 - speed
+
+
+def fade_frames(color1, color2, steps=100, delay=0, easing="linear", gamma=1.0):
+    """ fade between two rgb tuples, color2 is the last frame"""
+    table = fade_table(tuple(color1), tuple(color2), steps, easing, gamma)
+    for rgb in table_colors(table):
+        yield ("color", rgb), delay
+
+
+def hsv_sweep_frames(cycle_time=10, steps=120, gamma=1.0):
+    """ continuous loop around the hue wheel"""
+    table = hsv_sweep_table(steps, gamma=gamma)
+    while True:
+        for rgb in table_colors(table):
+            yield ("color", rgb), cycle_time / steps
+
+
+def color_cycle_frames(color_time=2, cross_fade=False, fade_steps=100):
+    """ hold every COLOR_WHEEL color for color_time, cross_fade fades to
+    the next one in fade_steps engine ticks"""
+    steps = fade_steps if cross_fade else 1
+    table = wheel_table(COLOR_WHEEL, steps)
+    while True:
+        for i, rgb in enumerate(table_colors(table)):
+            # wheel colors start every segment, fade steps fill the rest
+            yield ("color", rgb), color_time if i % steps == 0 else 0
+
+
+def random_color_frames(color_time=2):
+    while True:
+        yield ("color", (random.randint(0, 255),
+                         random.randint(0, 255),
+                         random.randint(0, 255))), color_time
+
+
+class LightEffect:
+    """ a running effect, owns its bulbs until it finishes or is cancelled
+
+    every frame is computed once and sent to all member bulbs in the
+    same tick, a bulb taken over by another effect leaves the group"""
+
+    def __init__(self, name, bulbs, frames):
+        self.name = name
+        self.bulbs = list(bulbs)
+        self.frames = frames
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    @property
+    def running(self):
+        return not self.cancelled
+
+
+class LightEffectsEngine(Thread):
+    """ steps every running light effect from a single thread
+
+    wake ups are aligned to a shared tick, all effects due in the same
+    tick are stepped together and no step runs faster than one tick,
+    frames are dispatched to bulbs concurrently from a small thread pool"""
+
+    def __init__(self, tick=0.05, max_workers=8, dispatch_timeout=1):
+        super().__init__(daemon=True)
+        self.tick = tick
+        self.dispatch_timeout = dispatch_timeout
+        self.executor = ThreadPoolExecutor(max_workers=max_workers,
+                                           thread_name_prefix="iot-effects")
+        self._owners = {}  # bulb -> LightEffect
+        self._queue = []  # min-heap of (due, seq, LightEffect)
+        self._seq = itertools.count()
+        self._cond = Condition()
+        self._running = False
+
+    def _align(self, due):
+        # tolerance, float error must not push a due frame to the next tick
+        return math.ceil(due / self.tick - 1e-6) * self.tick
+
+    def start_effect(self, bulbs, name, frames):
+        """ run an effect on one or more bulbs
+
+        bulbs are taken from the effects they currently run"""
+        effect = LightEffect(name, bulbs, frames)
+        with self._cond:
+            for bulb in effect.bulbs:
+                self._release(bulb)
+                self._owners[bulb] = effect
+                bulb.mode = name
+            heapq.heappush(self._queue, (self._align(time.monotonic()),
+                                         next(self._seq), effect))
+            self._cond.notify()
+            start, self._running = not self._running, True
+        if start:
+            self.start()
+        return effect
+
+    def _release(self, bulb):
+        effect = self._owners.pop(bulb, None)
+        if effect is not None:
+            effect.bulbs.remove(bulb)
+            if not effect.bulbs:
+                effect.cancel()
+        bulb.mode = ""
+
+    def stop_effect(self, bulb):
+        with self._cond:
+            self._release(bulb)
+
+    def effect_of(self, bulb):
+        """ the LightEffect currently owning a bulb, if any"""
+        return self._owners.get(bulb)
+
+    def _finish(self, effect):
+        with self._cond:
+            for bulb in list(effect.bulbs):
+                self._release(bulb)
+            effect.cancel()
+
+    def _next_frame(self, effect):
+        """ returns the next (frame, delay) or None if the effect is done"""
+        try:
+            return next(effect.frames)
+        except StopIteration:
+            pass
+        except Exception as e:
+            LOG.error(f"light effect {effect.name} failed: {e}")
+        self._finish(effect)
+        return None
+
+    def dispatch(self, bulbs, frame):
+        """ send a frame to many bulbs, returns the pending group futures
+
+        bulb classes with group_commands get a single apply_group_frame call,
+        every other bulb gets the frame through its rate limited command
+        queue, a frame the bulb could not keep up with is coalesced away and
+        one that finds the queue full of other commands is skipped"""
+        futures = []
+        by_class = {}
+        for bulb in bulbs:
+            by_class.setdefault(type(bulb), []).append(bulb)
+        commands = get_command_dispatcher()
+        for clazz, members in by_class.items():
+            if getattr(clazz, "group_commands", False):
+                futures.append(self.executor.submit(clazz.apply_group_frame, members, frame))
+            else:
+                for bulb in members:
+                    try:
+                        commands.submit(bulb, "apply_frame", frame, timeout=0,
+                                        coalesce=FRAME_COALESCE_KEYS[frame[0]])
+                    except Full:
+                        pass  # never stall the shared engine for one bulb
+        return futures
+
+    def run(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                now = time.monotonic()
+                due = self._queue[0][0]
+                if due > now:
+                    self._cond.wait(due - now)
+                    continue
+                batch = []
+                while self._queue and self._queue[0][0] <= now:
+                    batch.append(heapq.heappop(self._queue))
+
+            # compute every due frame, then send them all in one batch
+            futures = []
+            for due, _, effect in batch:
+                if effect.cancelled:
+                    continue
+                step = self._next_frame(effect)
+                if step is None:
+                    continue
+                frame, delay = step
+                if frame is not None:
+                    with self._cond:
+                        bulbs = list(effect.bulbs)
+                    futures += self.dispatch(bulbs, frame)
+                # schedule relative to the planned time so effects do not drift
+                next_due = self._align(max(due + max(delay or 0, self.tick),
+                                           time.monotonic()))
+                with self._cond:
+                    if not effect.cancelled:
+                        heapq.heappush(self._queue, (next_due, next(self._seq), effect))
+            if futures:
+                wait(futures, timeout=self.dispatch_timeout)
+                for future in futures:
+                    if future.done() and future.exception():
+                        LOG.error(f"light effect frame failed: {future.exception()}")
+
+
+_ENGINE = None
+_ENGINE_LOCK = Lock()
+
+
+def get_effects_engine():
+    """ the shared LightEffectsEngine, its thread starts with the first effect"""
+    global _ENGINE
+    with _ENGINE_LOCK:
+        if _ENGINE is None:
+            _ENGINE = LightEffectsEngine()
+    return _ENGINE
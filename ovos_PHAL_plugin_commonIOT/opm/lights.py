@@ -1,21 +1,45 @@
-import itertools
 import random
-import time
-from threading import Thread
-from time import sleep
+from functools import lru_cache
 
 from lingua_franca.util.colors import Color
 
 from ovos_PHAL_plugin_commonIOT.opm.base import IOTCapabilties, Switch, IOTDeviceType, Plug
+from ovos_PHAL_plugin_commonIOT.opm.effects import get_effects_engine, beacon_frames, beacon_slow_frames, \
+    blink_frames, color_cycle_frames, fade_frames, random_color_frames, hsv_sweep_frames
+
+
+@lru_cache(maxsize=1024)
+def _color_from_rgb(rgb):
+    # effect frames reuse a small set of colors, do not allocate one per step
+    return Color.from_rgb(*rgb)
+
+
+def _brightness_written(value, percent=True, *args, **kwargs):
+    # brightness_255 is an int, like the property it caches
+    if percent:
+        return {"brightness": value, "brightness_255": round(value * 255 / 100)}
+    return {"brightness": value * 100 / 255, "brightness_255": round(value)}
+
+
+def _color_written(color="white", *args, **kwargs):
+    if not isinstance(color, Color):
+        color = Color.from_name(color)
+    return {"color": color}
 
 
 class Bulb(Switch):
+    __slots__ = ()
     capabilities = Plug.capabilities + [
         IOTCapabilties.REPORT_BRIGHTNESS,
         IOTCapabilties.CHANGE_BRIGHTNESS,
         IOTCapabilties.BLINK_LIGHT,
         IOTCapabilties.BEACON_LIGHT
     ]
+    state_ttl = {**Switch.state_ttl, "brightness": 5, "brightness_255": 5}
+    state_writes = {**Switch.state_writes,
+                    "change_brightness": _brightness_written,
+                    "change_color": _color_written}
+    async_methods = Switch.async_methods + ("change_brightness", "change_color")
 
     def __init__(self, device_id, host=None, name="generic_bulb",
                  area=None, device_type=IOTDeviceType.BULB, raw_data=None):
@@ -64,36 +88,62 @@ class Bulb(Switch):
         self.change_brightness(100)
 
     def reset(self):
-        self.mode = ""
-        self._timer = None
+        self.stop_effect()
         if self.is_off:
             self.turn_on()
         self.set_high_brightness()
 
+    # effects, stepped by the shared LightEffectsEngine
+    # set to True by plugins overriding apply_group_frame
+    group_commands = False
+
+    def apply_frame(self, frame):
+        """ apply a single effect frame, see opm.effects"""
+        command, value = frame
+        if command == "on":
+            self.turn_on()
+        elif command == "off":
+            self.turn_off()
+        elif command == "brightness":
+            self.change_brightness(value)
+        elif command == "color":
+            self.change_color(_color_from_rgb(value))
+
+    async def async_apply_frame(self, frame):
+        """ apply_frame for bulbs implementing the async commands"""
+        command, value = frame
+        if command == "on":
+            await self.async_turn_on()
+        elif command == "off":
+            await self.async_turn_off()
+        elif command == "brightness":
+            await self.async_change_brightness(value)
+        elif command == "color":
+            await self.async_change_color(_color_from_rgb(value))
+
+    @classmethod
+    def apply_group_frame(cls, bulbs, frame):
+        """ apply a frame to many bulbs of this class at once
+
+        plugins whose protocol has multicast or group commands override
+        this to send one packet per frame and set group_commands = True"""
+        for bulb in bulbs:
+            bulb.apply_frame(frame)
+
+    def start_effect(self, name, frames):
+        """ run a frame generator as this bulb's effect, see opm.effects"""
+        return get_effects_engine().start_effect([self], name, frames)
+
+    def stop_effect(self):
+        get_effects_engine().stop_effect(self)
+
     def beacon_slow(self, speed=0.9):
 
         assert 0 <= speed <= 1
 
         if self.is_off:
             self.turn_on()
-        self.mode = "beacon"
-
-        def cycle():
-            while self.mode == "beacon":
-                i = 5
-                while i < 100:
-                    i += 5
-                    self.change_brightness(i)
-                    sleep(1 - speed)
-
-                while i > 5:
-                    i -= 5
-                    self.change_brightness(i)
-                    sleep(1 - speed)
-
-        self._timer = Thread(target=cycle)
-        self._timer.setDaemon(True)
-        self._timer.start()
+        self.start_effect("beacon", beacon_slow_frames(speed))
 
     def beacon(self, speed=0.7):
 
@@ -101,47 +151,26 @@ class Bulb(Switch):
 
         if self.is_off:
             self.turn_on()
-        self.mode = "beacon"
-
-        def cycle():
-            while self.mode == "beacon":
-                self.change_brightness(100)
-                sleep(1 - speed)
-                self.change_brightness(50)
-                sleep(1 - speed)
-                self.change_brightness(1)
-                sleep(1 - speed)
-                self.change_brightness(50)
-
-        self._timer = Thread(target=cycle)
-        self._timer.setDaemon(True)
-        self._timer.start()
+        self.start_effect("beacon", beacon_frames(speed))
 
     def blink(self, speed=0):
 
         assert 0 <= speed <= 1
 
-        self.mode = "blink"
         if self.is_off:
             self.turn_on()
-
-        def cycle():
-            while self.mode == "blink":
-                self.turn_off()
-                sleep(1 - speed)
-                self.turn_on()
-                sleep(1 - speed)
-
-        self._timer = Thread(target=cycle)
-        self._timer.setDaemon(True)
-        self._timer.start()
+        self.start_effect("blink", blink_frames(speed))
 
 
 class RGBBulb(Bulb):
+    __slots__ = ()
     capabilities = Bulb.capabilities + [
         IOTCapabilties.REPORT_COLOR,
         IOTCapabilties.CHANGE_COLOR
     ]
+    state_ttl = {**Bulb.state_ttl, "color": 5}
+    async_methods = Bulb.async_methods + ("change_color_hex", "change_color_hsv",
+                                          "change_color_rgb", "random_color")
 
     def __init__(self, device_id, host=None, name="generic_rgb_bulb",
                  area=None, device_type=IOTDeviceType.RGB_BULB, raw_data=None):
@@ -172,126 +201,93 @@ class RGBBulb(Bulb):
     def change_color_rgb(self, r, g, b):
         self.change_color(Color.from_rgb(r, g, b))
 
-    def cross_fade(self, color1, color2, steps=100):
+    def cross_fade(self, color1, color2, steps=100, duration=None,
+                   easing="linear", gamma=1.0):
+        """ fade as a light effect, one step per engine tick unless a
+        duration is given, steps go through the rate limited command queue"""
         if isinstance(color1, Color):
             color1 = color1.rgb255
         if isinstance(color2, Color):
             color2 = color2.rgb255
-        r1, g1, b1 = color1
-        r2, g2, b2 = color2
-        for i in range(1, steps + 1):
-            r = r1 - int(i * float(r1 - r2) // steps)
-            g = g1 - int(i * float(g1 - g2) // steps)
-            b = b1 - int(i * float(b1 - b2) // steps)
-
-            self.change_color_rgb(r, g, b)
+        delay = duration / steps if duration else 0
+        return self.start_effect("fade", fade_frames(color1, color2, steps, delay,
+                                                     easing, gamma))
 
     def color_cycle(self, color_time=2, cross_fade=False):
-        self.mode = "color_cycle"
-        # print("Light mode: {mode}".format(mode=self.mode))
         if self.is_off:
             self.turn_on()
+        self.start_effect("color_cycle", color_cycle_frames(color_time, cross_fade))
 
-        def cycle_color():
-
-            class Red(Color):
-                def __new__(cls, *args, **kwargs):
-                    return Color.from_rgb(255, 0, 0)
-
-            class Orange(Color):
-                def __new__(cls, *args, **kwargs):
-                    return Color.from_rgb(255, 125, 0)
-
-            class Yellow(Color):
-                def __new__(cls, *args, **kwargs):
-                    return Color.from_rgb(255, 255, 0)
-
-            class SpringGreen(Color):
-                def __new__(cls, *args, **kwargs):
-                    return Color.from_rgb(125, 255, 0)
-
-            class Green(Color):
-                def __new__(cls, *args, **kwargs):
-                    return Color.from_rgb(0, 255, 0)
-
-            class Turquoise(Color):
-                def __new__(cls, *args, **kwargs):
-                    return Color.from_rgb(0, 255, 125)
-
-            class Cyan(Color):
-                def __new__(cls, *args, **kwargs):
-                    return Color.from_rgb(0, 255, 255)
-
-            class Ocean(Color):
-                def __new__(cls, *args, **kwargs):
-                    return Color.from_rgb(0, 125, 255)
-
-            class Blue(Color):
-                def __new__(cls, *args, **kwargs):
-                    return Color.from_rgb(0, 0, 255)
+    def random_color_cycle(self, color_time=2):
+        if self.is_off:
+            self.turn_on()
+        self.start_effect("random_color_cycle", random_color_frames(color_time))
 
-            class Violet(Color):
-                def __new__(cls, *args, **kwargs):
-                    return Color.from_rgb(125, 0, 255)
+    def hsv_cycle(self, cycle_time=10, steps=120):
+        if self.is_off:
+            self.turn_on()
+        self.start_effect("hsv_cycle", hsv_sweep_frames(cycle_time, steps))
 
-            class Magenta(Color):
-                def __new__(cls, *args, **kwargs):
-                    return Color.from_rgb(255, 0, 255)
+    def random_color(self):
+        color = Color.from_rgb(random.randint(0, 255), random.randint(0, 255), random.randint(0, 255))
+        self.change_color(color)
 
-            class Raspberry(Color):
-                def __new__(cls, *args, **kwargs):
-                    return Color.from_rgb(255, 0, 125)
 
-            colorwheel = [Red(), Orange(), Yellow(), SpringGreen(),
-                          Green(), Turquoise(), Cyan(), Ocean(),
-                          Blue(), Violet(), Magenta(), Raspberry()]
+class RGBWBulb(RGBBulb):
+    __slots__ = ()
 
-            # use cycle() to treat the list in a circular fashion
-            colorpool = itertools.cycle(colorwheel)
+    def __init__(self, device_id, host=None, name="generic_rgbw_bulb",
+                 area=None, device_type=IOTDeviceType.RGBW_BULB, raw_data=None):
+        super().__init__(device_id, host, name, area, device_type, raw_data)
 
-            # get the first color before the loop
-            color = next(colorpool)
 
-            while self.mode == "color_cycle":
-                # set to color and wait
-                self.change_color(color)
-                time.sleep(color_time)
+class LightGroup:
+    """ runs effects in sync across many bulbs
 
-                # fade from color to next color
-                next_color = next(colorpool)
-                if cross_fade:
-                    self.cross_fade(color, next_color)
+    each frame is computed once and sent to every member in the same tick"""
 
-                # ready for next loop
-                color = next_color
+    def __init__(self, bulbs, name="light_group"):
+        self.bulbs = list(bulbs)
+        self.name = name
 
-        self._timer = Thread(target=cycle_color)
-        self._timer.setDaemon(True)
-        self._timer.start()
+    def _start(self, effect, frames):
+        engine = get_effects_engine()
+        engine.dispatch([b for b in self.bulbs if b.is_off], ("on", None))
+        return engine.start_effect(self.bulbs, effect, frames)
 
-    def random_color_cycle(self, color_time=2):
-        self.mode = "random_color_cycle"
-        if self.is_off:
-            self.turn_on()
+    def _rgb_bulbs(self):
+        return LightGroup([b for b in self.bulbs if isinstance(b, RGBBulb)], self.name)
 
-        def cycle_color():
+    def stop(self):
+        engine = get_effects_engine()
+        for bulb in self.bulbs:
+            engine.stop_effect(bulb)
 
-            while self.mode == "random_color_cycle":
-                # set to color and wait
-                self.random_color()
-                time.sleep(color_time)
+    def fade(self, color1, color2, steps=100, duration=None,
+             easing="linear", gamma=1.0):
+        if isinstance(color1, Color):
+            color1 = color1.rgb255
+        if isinstance(color2, Color):
+            color2 = color2.rgb255
+        delay = duration / steps if duration else 0
+        return self._rgb_bulbs()._start("fade", fade_frames(color1, color2, steps, delay,
+                                                            easing, gamma))
 
-        self._timer = Thread(target=cycle_color)
-        self._timer.setDaemon(True)
-        self._timer.start()
+    def color_cycle(self, color_time=2, cross_fade=False):
+        return self._rgb_bulbs()._start("color_cycle",
+                                        color_cycle_frames(color_time, cross_fade))
 
-    def random_color(self):
-        color = Color.from_rgb(random.randint(0, 255), random.randint(0, 255), random.randint(0, 255))
-        self.change_color(color)
+    def hsv_cycle(self, cycle_time=10, steps=120):
+        return self._rgb_bulbs()._start("hsv_cycle", hsv_sweep_frames(cycle_time, steps))
 
+    def beacon(self, speed=0.7):
+        assert 0 <= speed <= 1
+        return self._start("beacon", beacon_frames(speed))
 
-class RGBWBulb(RGBBulb):
-    def __init__(self, device_id, host=None, name="generic_rgbw_bulb",
-                 area=None, device_type=IOTDeviceType.RGBW_BULB, raw_data=None):
-        super().__init__(device_id, host, name, area, device_type, raw_data)
+    def beacon_slow(self, speed=0.9):
+        assert 0 <= speed <= 1
+        return self._start("beacon", beacon_slow_frames(speed))
 
+    def blink(self, speed=0):
+        assert 0 <= speed <= 1
+        return self._start("blink", blink_frames(speed))
@@ -0,0 +1,261 @@
+""" in process metrics for scanners, device commands and queues
+
+metrics are module level objects, hot paths only take a lock and bump a
+number, collect() and prometheus() build the reports on request"""
+import math
+import time
+from bisect import bisect_left
+from threading import Lock
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, documentation="", labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}  # label values tuple -> metric state
+        self._lock = Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def _labels(self, key):
+        return dict(zip(self.labelnames, key))
+
+    def samples(self):
+        """ [(labels dict, value)] """
+        with self._lock:
+            return [(self._labels(k), v) for k, v in self._values.items()]
+
+    def collect(self):
+        return {"type": self.kind, "help": self.documentation,
+                "values": [{"labels": labels, "value": value}
+                           for labels, value in self.samples()]}
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Counter(Metric):
+    """ monotonically increasing count, eg. errors"""
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Meter(Counter):
+    """ a counter that also tracks its recent rate
+
+    rate is an exponentially weighted moving average of events per second
+    over roughly the last minute, updated every 5 seconds"""
+    TICK = 5
+    ALPHA = 1 - math.exp(-TICK / 60)
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0, 0, 0.0, time.monotonic()]  # total, uncounted, rate, last tick
+            self._tick(state)
+            state[0] += amount
+            state[1] += amount
+
+    def _tick(self, state):
+        now = time.monotonic()
+        while now - state[3] >= self.TICK:
+            instant = state[1] / self.TICK
+            state[2] += self.ALPHA * (instant - state[2])
+            state[1] = 0
+            state[3] += self.TICK
+
+    def samples(self):
+        with self._lock:
+            for state in self._values.values():
+                self._tick(state)
+            return [(self._labels(k), v[0]) for k, v in self._values.items()]
+
+    def collect(self):
+        with self._lock:
+            values = []
+            for key, state in self._values.items():
+                self._tick(state)
+                values.append({"labels": self._labels(key), "value": state[0],
+                               "rate_1m": state[2]})
+        return {"type": self.kind, "help": self.documentation, "values": values}
+
+
+class Gauge(Metric):
+    """ a value that goes up and down, callback reads it at collection time
+
+    callback returns a number or a {label values tuple: number} dict"""
+    kind = "gauge"
+
+    def __init__(self, name, documentation="", labelnames=(), callback=None):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def samples(self):
+        if self.callback is None:
+            return super().samples()
+        try:
+            values = self.callback()
+        except Exception:
+            return []
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [(self._labels(tuple(str(k) for k in (key if isinstance(key, tuple) else (key,)))), v)
+                for key, v in values.items()]
+
+
+class Histogram(Metric):
+    """ latency distribution with fixed buckets, in seconds"""
+    kind = "histogram"
+
+    def __init__(self, name, documentation="", labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        idx = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # per bucket counts (last one is +Inf), count, sum
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0, 0.0]
+            state[0][idx] += 1
+            state[1] += 1
+            state[2] += value
+
+    def time(self, **labels):
+        """ context manager observing the duration of its block"""
+        return _Timer(self, labels)
+
+    def quantile(self, counts, total, q):
+        """ upper bound of the bucket holding the q quantile,
+        None if it falls past the last bucket"""
+        rank = q * total
+        seen = 0
+        for bound, n in zip(self.buckets, counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return None
+
+    def samples(self):
+        with self._lock:
+            return [(self._labels(k), (list(v[0]), v[1], v[2]))
+                    for k, v in self._values.items()]
+
+    def collect(self):
+        values = []
+        for labels, (counts, total, value_sum) in self.samples():
+            values.append({
+                "labels": labels,
+                "count": total,
+                "sum": value_sum,
+                "mean": value_sum / total if total else None,
+                "p50": self.quantile(counts, total, 0.5),
+                "p95": self.quantile(counts, total, 0.95),
+                "p99": self.quantile(counts, total, 0.99),
+                "buckets": dict(zip([str(b) for b in self.buckets] + ["+Inf"],
+                                    _cumulative(counts)))
+            })
+        return {"type": self.kind, "help": self.documentation, "values": values}
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *args):
+        self.histogram.observe(time.monotonic() - self.start, **self.labels)
+
+
+def _cumulative(counts):
+    total = 0
+    out = []
+    for n in counts:
+        total += n
+        out.append(total)
+    return out
+
+
+class MetricsRegistry:
+    def __init__(self, prefix="ovos_iot_"):
+        self.prefix = prefix
+        self.metrics = {}
+        self._lock = Lock()
+
+    def _register(self, clazz, name, *args, **kwargs):
+        with self._lock:
+            if name not in self.metrics:
+                self.metrics[name] = clazz(self.prefix + name, *args, **kwargs)
+            return self.metrics[name]
+
+    def counter(self, name, documentation="", labelnames=()):
+        return self._register(Counter, name, documentation, labelnames)
+
+    def meter(self, name, documentation="", labelnames=()):
+        return self._register(Meter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation="", labelnames=(), callback=None):
+        gauge = self._register(Gauge, name, documentation, labelnames)
+        if callback is not None:
+            gauge.callback = callback
+        return gauge
+
+    def histogram(self, name, documentation="", labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram, name, documentation, labelnames, buckets)
+
+    def collect(self):
+        """ every metric as a JSON ready dict, keyed by name"""
+        return {name: metric.collect() for name, metric in list(self.metrics.items())}
+
+    def prometheus(self):
+        """ every metric in the Prometheus text exposition format"""
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for labels, value in metric.samples():
+                if metric.kind == "histogram":
+                    counts, total, value_sum = value
+                    for bound, n in zip([str(b) for b in metric.buckets] + ["+Inf"],
+                                        _cumulative(counts)):
+                        lines.append(f"{metric.name}_bucket{_format_labels({**labels, 'le': bound})} {n}")
+                    lines.append(f"{metric.name}_count{_format_labels(labels)} {total}")
+                    lines.append(f"{metric.name}_sum{_format_labels(labels)} {value_sum}")
+                else:
+                    suffix = "_total" if metric.kind == "counter" else ""
+                    lines.append(f"{metric.name}{suffix}{_format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+               for v in labels.values())
+    return "{" + ",".join(f'{k}="{v}"' for k, v in zip(labels, escaped)) + "}"
+
+
+METRICS = MetricsRegistry()
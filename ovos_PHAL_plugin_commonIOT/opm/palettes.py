@@ -0,0 +1,71 @@
+""" precomputed color transition tables for light effects
+
+tables are flat rgb byte buffers (r0, g0, b0, r1, g1, b1, ...) built once
+in an array('B') and cached as immutable bytes, so every effect and every
+bulb reuses the same table"""
+import colorsys
+import math
+from array import array
+from functools import lru_cache
+
+EASINGS = {
+    "linear": lambda t: t,
+    "ease_in": lambda t: t * t,
+    "ease_out": lambda t: 1 - (1 - t) * (1 - t),
+    "ease_in_out": lambda t: t * t * (3 - 2 * t),
+    "sine": lambda t: (1 - math.cos(math.pi * t)) / 2
+}
+
+
+@lru_cache(maxsize=16)
+def gamma_table(gamma=1.0):
+    """ 0-255 -> 0-255 gamma correction lookup"""
+    return bytes(round(255 * (v / 255) ** gamma) for v in range(256))
+
+
+@lru_cache(maxsize=256)
+def fade_table(start, end, steps=100, easing="linear", gamma=1.0):
+    """ steps colors going from start (excluded) to end (included)"""
+    ease = EASINGS[easing]
+    correct = gamma_table(gamma)
+    table = array("B")
+    for i in range(1, steps + 1):
+        t = ease(i / steps)
+        for c1, c2 in zip(start, end):
+            table.append(correct[round(c1 + (c2 - c1) * t)])
+    return table.tobytes()
+
+
+@lru_cache(maxsize=32)
+def wheel_table(colors, steps_per_color=1, easing="linear", gamma=1.0):
+    """ a closed loop through colors, steps_per_color > 1 fades between them
+
+    the table starts at colors[0]"""
+    correct = gamma_table(gamma)
+    table = bytearray()
+    for i, color in enumerate(colors):
+        table += bytes(correct[c] for c in color)
+        if steps_per_color > 1:
+            next_color = colors[(i + 1) % len(colors)]
+            # the fade ends on next_color, which starts the next segment
+            table += fade_table(color, next_color, steps_per_color, easing, gamma)[:-3]
+    return bytes(table)
+
+
+@lru_cache(maxsize=32)
+def hsv_sweep_table(steps=360, saturation=1.0, value=1.0, gamma=1.0):
+    """ hue sweep around the color wheel at fixed saturation and value"""
+    correct = gamma_table(gamma)
+    table = array("B")
+    for i in range(steps):
+        r, g, b = colorsys.hsv_to_rgb(i / steps, saturation, value)
+        table.extend((correct[round(r * 255)],
+                      correct[round(g * 255)],
+                      correct[round(b * 255)]))
+    return table.tobytes()
+
+
+def table_colors(table):
+    """ iterate a table as (r, g, b) tuples"""
+    for i in range(0, len(table), 3):
+        yield table[i], table[i + 1], table[i + 2]
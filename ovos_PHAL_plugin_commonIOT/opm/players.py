@@ -2,6 +2,7 @@ from ovos_PHAL_plugin_commonIOT.opm.base import IOTCapabilties, IOTDeviceType, P
 
 
 class MediaPlayer(Plug):
+    __slots__ = ()
     capabilities = Plug.capabilities + [
         IOTCapabilties.PAUSE_PLAYBACK,
         IOTCapabilties.RESUME_PLAYBACK,
@@ -9,6 +10,7 @@ class MediaPlayer(Plug):
         IOTCapabilties.NEXT_PLAYBACK,
         IOTCapabilties.PREV_PLAYBACK
     ]
+    async_methods = Plug.async_methods + ("resume", "stop", "pause", "play_next", "play_prev")
 
     def __init__(self, device_id, host=None, name="generic_media_player",
                  area=None, device_type=IOTDeviceType.MEDIA_PLAYER, raw_data=None):
@@ -31,6 +33,8 @@ class MediaPlayer(Plug):
 
 
 class Radio(MediaPlayer):
+    __slots__ = ()
+
     def __init__(self, device_id, host=None, name="generic_radio",
                  area=None, device_type=IOTDeviceType.RADIO, raw_data=None):
         super().__init__(device_id, host, name, area, device_type, raw_data)
@@ -53,6 +57,8 @@ class Radio(MediaPlayer):
 
 
 class TV(MediaPlayer):
+    __slots__ = ()
+
     def __init__(self, device_id, host=None, name="generic_tv",
                  area=None, device_type=IOTDeviceType.TV, raw_data=None):
         super().__init__(device_id, host, name, area, device_type, raw_data)
@@ -0,0 +1,363 @@
+from collections.abc import Mapping, Set
+from threading import RLock
+
+from ovos_PHAL_plugin_commonIOT.opm.base import IOTAbstractDevice, capability_names
+
+
+class FrozenMap(Mapping):
+    """ read only dict split in hash buckets
+
+    update returns a new map sharing every bucket it did not change, the
+    number of buckets grows with the square root of the size, so a write
+    copies about sqrt(len) entries instead of the whole dict"""
+    __slots__ = ("_buckets", "_len")
+
+    def __init__(self, buckets=({},), length=0):
+        self._buckets = buckets  # power of two number of dicts, never mutated
+        self._len = length
+
+    def update(self, items=(), discard=()):
+        """ new map with the (key, value) items set and the discard keys removed"""
+        buckets = list(self._buckets)
+        mask = len(buckets) - 1
+        copied = set()
+        length = self._len
+        for key in discard:
+            i = hash(key) & mask
+            if key in buckets[i]:
+                if i not in copied:
+                    buckets[i] = dict(buckets[i])
+                    copied.add(i)
+                del buckets[i][key]
+                length -= 1
+        for key, value in items:
+            i = hash(key) & mask
+            if i not in copied:
+                buckets[i] = dict(buckets[i])
+                copied.add(i)
+            if key not in buckets[i]:
+                length += 1
+            buckets[i][key] = value
+        if length > 2 * len(buckets) ** 2:
+            return FrozenMap._rehash(buckets, length)
+        return FrozenMap(tuple(buckets), length)
+
+    @staticmethod
+    def _rehash(buckets, length):
+        size = len(buckets)
+        while length > 2 * size ** 2:
+            size *= 2
+        rehashed = [{} for _ in range(size)]
+        for bucket in buckets:
+            for key, value in bucket.items():
+                rehashed[hash(key) & (size - 1)][key] = value
+        return FrozenMap(tuple(rehashed), length)
+
+    def set(self, key, value):
+        buckets = self._buckets
+        i = hash(key) & (len(buckets) - 1)
+        bucket = dict(buckets[i])
+        length = self._len if key in bucket else self._len + 1
+        bucket[key] = value
+        if length > 2 * len(buckets) ** 2:
+            return FrozenMap._rehash(buckets[:i] + (bucket,) + buckets[i + 1:], length)
+        return FrozenMap(buckets[:i] + (bucket,) + buckets[i + 1:], length)
+
+    def discard(self, key):
+        return self.update(discard=(key,)) if key in self else self
+
+    def _bucket(self, key):
+        return self._buckets[hash(key) & (len(self._buckets) - 1)]
+
+    def __getitem__(self, key):
+        return self._bucket(key)[key]
+
+    def get(self, key, default=None):
+        return self._bucket(key).get(key, default)
+
+    def __contains__(self, key):
+        return key in self._bucket(key)
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        for bucket in self._buckets:
+            yield from bucket
+
+    def values(self):
+        return [value for bucket in self._buckets for value in bucket.values()]
+
+    def items(self):
+        return [item for bucket in self._buckets for item in bucket.items()]
+
+
+class FrozenIdSet(Set):
+    """ frozen set of device_ids kept in a FrozenMap, for index keys shared
+    by many devices, add and discard copy a single bucket"""
+    __slots__ = ("_map",)
+
+    def __init__(self, ids=()):
+        self._map = ids if isinstance(ids, FrozenMap) else \
+            FrozenMap().update((device_id, None) for device_id in ids)
+
+    @classmethod
+    def _from_iterable(cls, it):
+        return frozenset(it)  # results of set operations
+
+    def __and__(self, other):
+        if not isinstance(other, Set):
+            return NotImplemented
+        small, large = (self, other) if len(self) <= len(other) else (other, self)
+        return frozenset(device_id for device_id in small if device_id in large)
+
+    __rand__ = __and__
+
+    def add(self, device_id):
+        return FrozenIdSet(self._map.set(device_id, None))
+
+    def discard(self, device_id):
+        return FrozenIdSet(self._map.discard(device_id))
+
+    def __contains__(self, device_id):
+        return device_id in self._map
+
+    def __len__(self):
+        return len(self._map)
+
+    def __iter__(self):
+        return iter(self._map)
+
+    def __hash__(self):
+        return self._hash()
+
+
+def _with_id(ids, device_id):
+    """ index entry ids plus device_id, bucketed once it gets large"""
+    if ids is None:
+        return frozenset((device_id,))
+    if isinstance(ids, frozenset):
+        if len(ids) < 64:
+            return ids | {device_id}
+        ids = FrozenIdSet(ids)
+    return ids.add(device_id)
+
+
+def _without_id(ids, device_id):
+    if isinstance(ids, frozenset):
+        return ids - {device_id}
+    return ids.discard(device_id)
+
+
+class RegistrySnapshot:
+    """ immutable view of the registry at one point in time
+
+    readers work on a snapshot and never see a half applied update"""
+    __slots__ = ("version", "devices", "_indexes", "_keys", "_groups", "_sorted_ids")
+
+    def __init__(self, version, devices, indexes, keys, groups):
+        self.version = version
+        self.devices = devices  # FrozenMap device_id -> device
+        self._indexes = indexes  # index -> FrozenMap {key: set of device_ids}
+        self._keys = keys  # FrozenMap device_id -> {index: indexed value}
+        self._groups = groups  # FrozenMap device_id -> frozenset alias group
+        self._sorted_ids = None
+
+    def get(self, device_id):
+        return self.devices.get(device_id)
+
+    def lookup(self, index, key):
+        """ frozen set of device_ids whose indexed attribute equals key """
+        if index not in self._indexes:
+            raise ValueError(f"unknown index: {index}")
+        return self._indexes[index].get(key, frozenset())
+
+    def sorted_ids(self):
+        """ all device_ids in a stable order, used as pagination cursors"""
+        if self._sorted_ids is None:
+            self._sorted_ids = tuple(sorted(self.devices))
+        return self._sorted_ids
+
+    def plugin_of(self, device_id):
+        return self._keys.get(device_id, {}).get("plugin")
+
+    def capabilities_of(self, device_id):
+        """ capability names of a registered device"""
+        return self._keys.get(device_id, {}).get("capability", ())
+
+    def aliases(self, device_id):
+        """ device_ids of other devices sharing the same host """
+        return self._groups.get(device_id, frozenset()) - {device_id}
+
+    @property
+    def mappings(self):
+        return {dev_id: group - {dev_id}
+                for dev_id, group in self._groups.items() if len(group) > 1}
+
+    def __contains__(self, device_id):
+        return device_id in self.devices
+
+    def __len__(self):
+        return len(self.devices)
+
+    def __iter__(self):
+        return iter(self.devices)
+
+
+class DeviceRegistry:
+    """ device_id -> IOTAbstractDevice store with secondary indexes
+
+    every index maps an attribute value to the set of device_ids sharing it,
+    devices reachable through the same host form an alias group, the
+    capability index maps every capability name to the devices having it
+
+    safe for concurrent use, add and remove are serialized by a single lock
+    and publish a new immutable RegistrySnapshot in a single assignment,
+    sharing everything the write did not touch with the previous one,
+    readers never take the lock"""
+    INDEXES = ("host", "device_type", "area", "device_class", "plugin", "capability")
+    MULTI_INDEXES = ("capability",)  # one device is indexed under many keys
+
+    def __init__(self):
+        self._class_capabilities = {}  # device class -> capability names
+        self._lock = RLock()
+        self._snapshot = RegistrySnapshot(0, FrozenMap(), {idx: FrozenMap() for idx in self.INDEXES},
+                                          FrozenMap(), FrozenMap())
+
+    def _index_keys(self, device: IOTAbstractDevice, plugin=None):
+        keys = {
+            "host": device.host,
+            "device_type": device.device_type,
+            "area": device.device_area,
+            "device_class": device.__class__.__name__,
+            "plugin": plugin
+        }
+        for idx, key in list(keys.items()):
+            try:
+                hash(key)
+            except TypeError:  # eg, area reported as a dict by some scanners
+                key = None
+            if key is None:
+                keys.pop(idx)
+        clazz = type(device)
+        if clazz not in self._class_capabilities:
+            self._class_capabilities[clazz] = capability_names(clazz.capability_mask)
+        keys["capability"] = self._class_capabilities[clazz]
+        return keys
+
+    @classmethod
+    def _keys_of(cls, idx, key):
+        return key if idx in cls.MULTI_INDEXES else (key,)
+
+    # writes, serialized
+    def add(self, device: IOTAbstractDevice, plugin=None):
+        """ register a device, returns the device_ids of its aliases """
+        device_id = device.device_id
+        keys = self._index_keys(device, plugin)
+        with self._lock:
+            current = self._snapshot
+            if current._keys.get(device_id) == keys:
+                # re-registered without changing any indexed value
+                if current.devices[device_id] is not device:
+                    self._snapshot = RegistrySnapshot(current.version + 1,
+                                                      current.devices.set(device_id, device),
+                                                      current._indexes, current._keys,
+                                                      current._groups)
+                return current._groups[device_id] - {device_id}
+            devices, indexes, index_keys, groups = self._without(current, device_id)
+            for idx, key in keys.items():
+                index = indexes[idx]
+                for k in self._keys_of(idx, key):
+                    index = index.set(k, _with_id(index.get(k), device_id))
+                indexes[idx] = index
+            devices = devices.set(device_id, device)
+            index_keys = index_keys.set(device_id, keys)
+
+            # devices with the same host are the same physical device
+            group = frozenset((device_id,))
+            if "host" in keys:
+                for alias_id in indexes["host"][keys["host"]]:
+                    if alias_id != device_id:
+                        group |= groups[alias_id]
+                        break
+            groups = groups.update([(member, group) for member in group])
+            self._snapshot = RegistrySnapshot(current.version + 1, devices, indexes,
+                                              index_keys, groups)
+            return group - {device_id}
+
+    def remove(self, device_id):
+        """ unregister a device from the store, indexes and alias groups """
+        with self._lock:
+            current = self._snapshot
+            device = current.devices.get(device_id)
+            if device is not None:
+                self._snapshot = RegistrySnapshot(current.version + 1,
+                                                  *self._without(current, device_id))
+            return device
+
+    def _without(self, snapshot, device_id):
+        """ (devices, indexes, keys, groups) of snapshot minus a device,
+        indexes is a new dict the caller may update"""
+        devices, index_keys, groups = snapshot.devices, snapshot._keys, snapshot._groups
+        indexes = dict(snapshot._indexes)
+        if device_id not in devices:
+            return devices, indexes, index_keys, groups
+        for idx, key in index_keys[device_id].items():
+            index = indexes[idx]
+            changed, emptied = [], []
+            for k in self._keys_of(idx, key):
+                ids = index.get(k)
+                if ids is not None:
+                    ids = _without_id(ids, device_id)
+                    if ids:
+                        changed.append((k, ids))
+                    else:
+                        emptied.append(k)
+            indexes[idx] = index.update(changed, emptied)
+        group = groups[device_id] - {device_id}
+        groups = groups.update([(member, group) for member in group], (device_id,))
+        return devices.discard(device_id), indexes, index_keys.discard(device_id), groups
+
+    # reads, lock free on the current snapshot
+    def snapshot(self):
+        """ current RegistrySnapshot"""
+        return self._snapshot
+
+    @property
+    def devices(self):
+        return self.snapshot().devices
+
+    def get(self, device_id):
+        return self.snapshot().get(device_id)
+
+    def lookup(self, index, key):
+        """ frozenset of device_ids whose indexed attribute equals key """
+        return self.snapshot().lookup(index, key)
+
+    def sorted_ids(self):
+        """ all device_ids in a stable order, used as pagination cursors"""
+        return self.snapshot().sorted_ids()
+
+    def capabilities_of(self, device_id):
+        """ capability names of a registered device"""
+        return self.snapshot().capabilities_of(device_id)
+
+    def plugin_of(self, device_id):
+        return self.snapshot().plugin_of(device_id)
+
+    def aliases(self, device_id):
+        """ device_ids of other devices sharing the same host """
+        return self.snapshot().aliases(device_id)
+
+    @property
+    def mappings(self):
+        return self.snapshot().mappings
+
+    def __contains__(self, device_id):
+        return device_id in self.snapshot()
+
+    def __len__(self):
+        return len(self.snapshot())
+
+    def __iter__(self):
+        return iter(self.snapshot())
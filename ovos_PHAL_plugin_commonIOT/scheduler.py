@@ -0,0 +1,78 @@
+import asyncio
+import random
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread
+
+from ovos_utils.log import LOG
+
+from ovos_PHAL_plugin_commonIOT.opm.base import IOTScannerPlugin
+
+
+class ScanScheduler(Thread):
+    """ runs every IOTScannerPlugin from a single asyncio event loop
+
+    blocking scan() implementations run in a bounded thread pool, at most
+    max_concurrent scans run at the same time and every wake up is
+    randomized by +/- jitter so scanners do not fire in lockstep"""
+
+    def __init__(self, max_workers=4, max_concurrent=2, jitter=0.2):
+        super().__init__(daemon=True)
+        self.max_concurrent = max_concurrent
+        self.jitter = jitter
+        self.executor = ThreadPoolExecutor(max_workers=max_workers,
+                                           thread_name_prefix="iot-scan")
+        self.loop = asyncio.new_event_loop()
+        self.tasks = {}
+        self._semaphore = None
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def stop(self):
+        self.tasks.clear()
+        asyncio.run_coroutine_threadsafe(self._shutdown(), self.loop)
+        self.executor.shutdown(wait=False)
+
+    async def _shutdown(self):
+        tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.loop.stop()
+
+    def add(self, name, scanner: IOTScannerPlugin, interval=None):
+        """ schedule a scanner, interval overrides scanner.time_between_checks"""
+        self.remove(name)
+        self.tasks[name] = asyncio.run_coroutine_threadsafe(
+            self._scanner_loop(name, scanner, interval), self.loop)
+
+    def remove(self, name):
+        task = self.tasks.pop(name, None)
+        if task is not None:
+            task.cancel()
+
+    def is_running(self, name):
+        """ False once a scanner loop ended, eg. listen() raised"""
+        task = self.tasks.get(name)
+        return task is not None and not task.done()
+
+    def _next_delay(self, interval):
+        return max(0.0, interval * (1 + random.uniform(-self.jitter, self.jitter)))
+
+    async def _scanner_loop(self, name, scanner: IOTScannerPlugin, interval=None):
+        if self._semaphore is None:  # bound to the scheduler loop
+            self._semaphore = asyncio.Semaphore(self.max_concurrent)
+
+        if scanner.push_mode:
+            await self.loop.run_in_executor(self.executor, scanner.listen)
+
+        # random initial offset, spreads scanners over the first interval
+        await asyncio.sleep(random.uniform(0, interval or scanner.time_between_checks))
+        while True:
+            async with self._semaphore:
+                try:
+                    await self.loop.run_in_executor(self.executor, scanner.scan_once)
+                except Exception as e:
+                    LOG.error(f"{name} scan failed: {e}")
+            await asyncio.sleep(self._next_delay(interval or scanner.time_between_checks))
@@ -0,0 +1,148 @@
+import time
+from threading import Thread, Event, RLock
+
+from ovos_utils.log import LOG
+from ovos_utils.messagebus import Message
+
+
+class ScannerHealth:
+    """ supervision state of a single scanner plugin"""
+
+    def __init__(self, plugin):
+        self.plugin = plugin
+        self.status = "loading"  # loading, running, failed or restarting
+        self.failures = 0  # load errors, crashes and failed scan streaks
+        self.restarts = 0
+        self.backoff_step = 0  # restarts since the scanner was last healthy
+        self.last_error = None
+        self.load_time = None
+        self.started = None  # monotonic
+        self.next_restart = None  # monotonic
+
+    def as_dict(self, scanner=None):
+        now = time.monotonic()
+        data = {
+            "plugin": self.plugin,
+            "status": self.status,
+            "failures": self.failures,
+            "restarts": self.restarts,
+            "last_error": self.last_error,
+            "load_time": self.load_time,
+            "uptime": now - self.started if self.started and self.status == "running" else None,
+            "next_restart": max(0, self.next_restart - now) if self.next_restart else None
+        }
+        if scanner is not None:
+            data["devices"] = len(scanner.timestamps)
+            data["scan_interval"] = scanner.time_between_checks
+            data["last_scan"] = now - scanner.last_scan if scanner.last_scan else None
+        return data
+
+
+class ScannerSupervisor(Thread):
+    """ watches scanner plugins and restarts the failed ones
+
+    a scanner fails when it can not be loaded, its thread or scheduler
+    loop dies, max_scan_failures scans fail in a row, no scan starts for
+    stall_factor scan intervals or a single scan runs for more than
+    max_scan_time seconds, restarts back off exponentially from backoff up
+    to max_backoff seconds"""
+
+    def __init__(self, manager, interval=10, backoff=5, max_backoff=300,
+                 max_scan_failures=5, stall_factor=5, max_scan_time=300):
+        super().__init__(daemon=True)
+        self.manager = manager
+        self.interval = interval
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_scan_failures = max_scan_failures
+        self.stall_factor = stall_factor
+        self.max_scan_time = max_scan_time
+        self.health = {}  # plugin -> ScannerHealth
+        self._lock = RLock()
+        self._stopped = Event()
+
+    def health_of(self, plugin):
+        with self._lock:
+            if plugin not in self.health:
+                self.health[plugin] = ScannerHealth(plugin)
+            return self.health[plugin]
+
+    def report(self):
+        """ health of every supervised scanner, as sent on the bus"""
+        with self._lock:
+            return {plugin: health.as_dict(self.manager.scanners.get(plugin))
+                    for plugin, health in self.health.items()}
+
+    def publish(self, health):
+        self.manager.bus.emit(Message("ovos.iot.scanner.health",
+                                      health.as_dict(self.manager.scanners.get(health.plugin))))
+
+    def scanner_started(self, plugin, load_time=None):
+        with self._lock:
+            health = self.health_of(plugin)
+            health.status = "running"
+            health.load_time = load_time
+            health.started = time.monotonic()
+            health.next_restart = None
+        self.publish(health)
+
+    def scanner_failed(self, plugin, error):
+        with self._lock:
+            health = self.health_of(plugin)
+            health.status = "failed"
+            health.failures += 1
+            health.last_error = repr(error) if isinstance(error, Exception) else str(error)
+            delay = min(self.backoff * 2 ** health.backoff_step, self.max_backoff)
+            health.backoff_step += 1
+            health.next_restart = time.monotonic() + delay
+        LOG.error(f"scanner {plugin} failed: {health.last_error}, restarting in {delay}s")
+        self.publish(health)
+
+    def _problem(self, plugin, health):
+        """ why a running scanner needs a restart, None if it is healthy"""
+        scanner = self.manager.scanners.get(plugin)
+        if scanner is None or not self.manager.scanner_alive(plugin):
+            return "scanner stopped"
+        if scanner.consecutive_failures >= self.max_scan_failures:
+            return f"{scanner.consecutive_failures} scans failed: {scanner.last_error!r}"
+        now = time.monotonic()
+        scan_started = scanner.scan_started
+        if scan_started is not None:
+            # slow scans are fine, only a scan that never returns is a stall
+            if now - scan_started > self.max_scan_time:
+                return f"scan running for more than {self.max_scan_time:.0f}s"
+        else:
+            last_activity = scanner.last_scan or health.started
+            limit = self.stall_factor * scanner.time_between_checks + self.interval
+            if now - last_activity > limit:
+                return f"no scan started for {limit:.0f}s"
+        if health.backoff_step and scanner.last_scan and scanner.last_scan > health.started \
+                and not scanner.consecutive_failures:
+            health.backoff_step = 0  # healthy again since the last restart
+        return None
+
+    def check(self):
+        now = time.monotonic()
+        with self._lock:
+            supervised = list(self.health.items())
+        for plugin, health in supervised:
+            if health.status == "running":
+                problem = self._problem(plugin, health)
+                if problem is not None:
+                    self.scanner_failed(plugin, problem)
+            elif health.status == "failed" and now >= health.next_restart:
+                with self._lock:
+                    health.status = "restarting"
+                    health.restarts += 1
+                LOG.info(f"restarting scanner {plugin}")
+                self.manager.restart_scanner(plugin)
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.check()
+            except Exception as e:
+                LOG.exception(f"scanner supervisor check failed: {e}")
+
+    def stop(self):
+        self._stopped.set()
@@ -2,6 +2,20 @@ from ovos_workshop.app import OVOSAbstractApplication
 
 
 class IOTVoiceInterface(OVOSAbstractApplication):
-    def __init__(self, bus=None):
+    def __init__(self, bus=None, device_manager=None):
         super().__init__(skill_id="ovos.iot", bus=bus)
+        self.device_manager = device_manager
         # TODO - pretend this is a skill and implement intents
+
+    def resolve_device(self, utterance, min_score=0.5, margin=0.1):
+        """ device_ids an utterance refers to, eg. "the kitchen lights"
+
+        every device scoring within margin of the best match is returned,
+        so a group reference acts on all of its members"""
+        if self.device_manager is None:
+            return []
+        matches = self.device_manager.resolve_device(utterance, limit=None)
+        if not matches or matches[0][1] < min_score:
+            return []
+        best = matches[0][1]
+        return [device_id for device_id, score in matches if score >= best - margin]